@@ -1 +0,0 @@
-cd /Users/biryukovvaleri/Documents/Projects/rag-knowledge-base
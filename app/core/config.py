@@ -1,4 +1,5 @@
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,34 +12,80 @@ def get_env_var(name: str, required: bool = True, default: str | None = None) ->
     return value
 
 
-# ======================
-# Supabase
-# ======================
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """
+    Все переменные окружения, прочитанные один раз при импорте.
+    Остальной код берёт значения отсюда и не вызывает os.getenv сам.
+    """
 
-SUPABASE_URL: str = get_env_var("SUPABASE_URL", required=True)
-SUPABASE_ANON_KEY: str | None = get_env_var("SUPABASE_ANON_KEY", required=False, default=None)
-SUPABASE_SERVICE_KEY: str = get_env_var("SUPABASE_SERVICE_KEY", required=True)
+    # Supabase
+    SUPABASE_URL: str
+    SUPABASE_ANON_KEY: str | None
+    SUPABASE_SERVICE_KEY: str
 
-# Это алиас для обратной совместимости (некоторые модули импортируют SUPABASE_KEY)
-SUPABASE_KEY: str = SUPABASE_SERVICE_KEY
+    # Optional Postgres URL
+    DATABASE_URL: str | None
 
+    # OpenAI API keys
+    OPENAI_API_KEY: str | None
+    EMBEDDINGS_API_KEY: str | None
+    LLM_API_KEY: str | None
+
+    # Telegram-бот
+    TELEGRAM_BOT_TOKEN: str | None
+    RAG_URL: str | None
+
+    # Сколько запросов embeddings один процесс ingest держит в полёте
+    # (общий лимит на все документы и потоки — под RPM OpenAI)
+    INGEST_EMBED_CONCURRENCY: int
+
+    # Токен для /admin/* эндпоинтов (заголовок X-Admin-Token);
+    # если не задан — эндпоинты отключены
+    ADMIN_TOKEN: str | None
+
+    @property
+    def SUPABASE_KEY(self) -> str:
+        # Это алиас для обратной совместимости (некоторые модули импортируют SUPABASE_KEY)
+        return self.SUPABASE_SERVICE_KEY
+
+
+def _load_settings() -> Settings:
+    # Старое имя — OPENAI_API_KEY
+    openai_api_key = get_env_var("OPENAI_API_KEY", required=False, default=None)
+
+    return Settings(
+        SUPABASE_URL=get_env_var("SUPABASE_URL", required=True),
+        SUPABASE_ANON_KEY=get_env_var("SUPABASE_ANON_KEY", required=False, default=None),
+        SUPABASE_SERVICE_KEY=get_env_var("SUPABASE_SERVICE_KEY", required=True),
+        DATABASE_URL=get_env_var("DATABASE_URL", required=False, default=None),
+        OPENAI_API_KEY=openai_api_key,
+        # Если EMBEDDINGS_API_KEY / LLM_API_KEY не заданы — используем OPENAI_API_KEY
+        EMBEDDINGS_API_KEY=os.getenv("EMBEDDINGS_API_KEY") or openai_api_key,
+        LLM_API_KEY=os.getenv("LLM_API_KEY") or openai_api_key,
+        TELEGRAM_BOT_TOKEN=get_env_var("TELEGRAM_BOT_TOKEN", required=False, default=None),
+        RAG_URL=get_env_var("RAG_URL", required=False, default=None),
+        INGEST_EMBED_CONCURRENCY=int(
+            get_env_var("INGEST_EMBED_CONCURRENCY", required=False, default="2")
+        ),
+        ADMIN_TOKEN=get_env_var("ADMIN_TOKEN", required=False, default=None),
+    )
 
-# ======================
-# Optional Postgres URL
-# ======================
 
-DATABASE_URL: str | None = get_env_var("DATABASE_URL", required=False, default=None)
+settings = _load_settings()
 
 
 # ======================
-# OpenAI API keys
+# Модульные алиасы для существующих импортов
 # ======================
 
-# Старое имя — OPENAI_API_KEY
-OPENAI_API_KEY: str | None = get_env_var("OPENAI_API_KEY", required=False, default=None)
+SUPABASE_URL: str = settings.SUPABASE_URL
+SUPABASE_ANON_KEY: str | None = settings.SUPABASE_ANON_KEY
+SUPABASE_SERVICE_KEY: str = settings.SUPABASE_SERVICE_KEY
+SUPABASE_KEY: str = settings.SUPABASE_KEY
 
-# Если EMBEDDINGS_API_KEY не задан — используем OPENAI_API_KEY
-EMBEDDINGS_API_KEY: str | None = os.getenv("EMBEDDINGS_API_KEY") or OPENAI_API_KEY
+DATABASE_URL: str | None = settings.DATABASE_URL
 
-# Если LLM_API_KEY не задан — используем OPENAI_API_KEY
-LLM_API_KEY: str | None = os.getenv("LLM_API_KEY") or OPENAI_API_KEY
+OPENAI_API_KEY: str | None = settings.OPENAI_API_KEY
+EMBEDDINGS_API_KEY: str | None = settings.EMBEDDINGS_API_KEY
+LLM_API_KEY: str | None = settings.LLM_API_KEY
@@ -1,19 +1,79 @@
+import threading
+
+import httpx
+import orjson
 from loguru import logger
-from supabase import create_client, Client
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
+from supabase import create_client, Client, ClientOptions
 
 from app.core.config import SUPABASE_URL, SUPABASE_SERVICE_KEY
 
+# Коды ошибок «RPC-функции нет»: PGRST202 — PostgREST не нашёл её в кэше схемы,
+# 42883 — undefined_function в самом Postgres. Запасной путь без RPC
+# допустим только при них; остальные ошибки RPC — настоящие ошибки.
+MISSING_FUNCTION_ERROR_CODES = ("PGRST202", "42883")
+
+# Размер пула соединений httpx-клиента Supabase: под него подбирается
+# число параллельных потоков ingest (см. ingest/auto/ingest_from_manifest.py)
+SUPABASE_MAX_CONNECTIONS = 20
+
+
+class OrjsonHttpxClient(httpx.Client):
+    """
+    httpx-клиент, который кодирует тела json= через orjson, а не stdlib json.
+    supabase-py отдаёт payload'ы (upsert/insert/rpc) именно через json=,
+    а для батчей с длинными текстами и векторами stdlib json заметно медленнее.
+    """
+
+    def request(self, method, url, *, content=None, json=None, headers=None, **kwargs):
+        if json is not None and content is None:
+            content = orjson.dumps(json, option=orjson.OPT_SERIALIZE_NUMPY)
+            headers = httpx.Headers(headers)
+            headers["Content-Type"] = "application/json"
+            json = None
+        return super().request(
+            method, url, content=content, json=json, headers=headers, **kwargs
+        )
+
+
+_client: Client | None = None
+_client_lock = threading.Lock()
+
 
 def get_supabase_client() -> Client:
     """
     Клиент Supabase для серверной логики (ingest, RAG API).
     Использует service key, чтобы иметь полный доступ к БД.
+
+    Клиент создаётся один раз на процесс и переиспользуется,
+    чтобы не поднимать новое HTTP-соединение на каждый запрос.
     """
-    logger.info("Creating Supabase client (service role)...")
-    if SUPABASE_URL is None or SUPABASE_SERVICE_KEY is None:
-        raise RuntimeError("SUPABASE_URL or SUPABASE_SERVICE_KEY is not set")
-    client: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-    return client
+    global _client
+    if _client is not None:
+        return _client
+
+    with _client_lock:
+        if _client is None:
+            logger.info("Creating Supabase client (service role)...")
+            if SUPABASE_URL is None or SUPABASE_SERVICE_KEY is None:
+                raise RuntimeError("SUPABASE_URL or SUPABASE_SERVICE_KEY is not set")
+            # Один пул keep-alive соединений на процесс: параллельные воркеры
+            # ingest (INSERT_WORKERS) и запросы API не открывают новые TLS-сессии
+            http_client = OrjsonHttpxClient(
+                timeout=DEFAULT_POSTGREST_CLIENT_TIMEOUT,
+                follow_redirects=True,
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=SUPABASE_MAX_CONNECTIONS,
+                    max_keepalive_connections=SUPABASE_MAX_CONNECTIONS,
+                ),
+            )
+            _client = create_client(
+                SUPABASE_URL,
+                SUPABASE_SERVICE_KEY,
+                options=ClientOptions(httpx_client=http_client),
+            )
+    return _client
 
 
 def test_connection() -> None:
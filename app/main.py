@@ -1,31 +1,68 @@
 from __future__ import annotations
 
-from typing import List, Optional, Literal, Dict
-
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+import asyncio
+import gzip
+import os
+import secrets
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Literal, Dict, Tuple
+
+import orjson
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemLoader
 from pydantic import BaseModel
 from openai import OpenAI
 
-from rag.retrieval import retrieve_top_k, get_openai_client
+from rag.retrieval import (
+    Chunk,
+    RetrievalUnavailableError,
+    retrieve_top_k_async,
+    get_openai_client,
+    invalidate_chunk_index,
+)
 from app.core.db import get_supabase_client
 from app.core.config import (
+    settings,
     OPENAI_API_KEY,
     EMBEDDINGS_API_KEY,
     LLM_API_KEY,
 )
 
-app = FastAPI()
-templates = Jinja2Templates(directory="app/templates")
+# orjson сериализует ответы /rag/* заметно быстрее стандартного json;
+# крупные ответы дополнительно сжимаются gzip
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+# Шаблоны компилируются один раз: без проверки mtime на каждый рендер
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader("app/templates"),
+        autoescape=True,
+        auto_reload=False,
+        cache_size=400,
+    )
+)
+
+
+@app.exception_handler(RetrievalUnavailableError)
+async def retrieval_unavailable_handler(request: Request, exc: RetrievalUnavailableError):
+    # БД не ответила на поиск, а подменить его нечем — клиенту стоит повторить позже
+    return JSONResponse(
+        {"status": "error", "error": "Retrieval is temporarily unavailable"},
+        status_code=503,
+        headers={"Retry-After": "5"},
+    )
 
 
 # === DEBUG: переменные окружения ===
 
 @app.get("/debug/env")
 def debug_env():
-    import os
-
     keys = [
         "SUPABASE_URL",
         "SUPABASE_KEY",
@@ -41,7 +78,7 @@ def debug_env():
 
     info = {}
     for k in keys:
-        v = os.getenv(k)
+        v = getattr(settings, k)
         info[k] = {
             "present": bool(v),
             "length": len(v) if v else 0,
@@ -128,6 +165,40 @@ def health():
     return {"status": "ok"}
 
 
+# === ADMIN: доступ только с токеном ===
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)) -> None:
+    """
+    Пускает к /admin/* только с заголовком X-Admin-Token, равным ADMIN_TOKEN.
+    Если ADMIN_TOKEN не задан, эндпоинты как будто не существуют (404).
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(
+        x_admin_token.encode("utf-8"), settings.ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# === ADMIN: сброс кэша групп книг после ingest ===
+# Сбрасывает кэш только в обработавшем запрос воркере (и общий файл на хосте);
+# остальные uvicorn-воркеры отдают свою копию до BOOK_GROUPS_TTL_SECONDS.
+
+@app.post("/admin/cache/book-groups/clear", dependencies=[Depends(require_admin_token)])
+def admin_clear_book_groups_cache():
+    invalidate_book_groups_cache()
+    return {"status": "ok"}
+
+
+# === ADMIN: сброс резидентного индекса чанков после ingest ===
+# Тоже только в этом воркере; в остальных индекс обновится по CHUNK_INDEX_TTL_SECONDS.
+
+@app.post("/admin/cache/chunk-index/clear", dependencies=[Depends(require_admin_token)])
+def admin_clear_chunk_index():
+    invalidate_chunk_index()
+    return {"status": "ok"}
+
+
 # === Модели запросов ===
 
 class RAGRequest(BaseModel):
@@ -153,8 +224,8 @@ class RAGAnswerRequest(BaseModel):
 # === НИЗКИЙ УРОВЕНЬ: /rag/query — «сырые» чанки ===
 
 @app.post("/rag/query")
-def rag_query(body: RAGRequest):
-    scored = retrieve_top_k(
+async def rag_query(body: RAGRequest):
+    scored = await retrieve_top_k_async(
         query=body.query,
         slug=body.slug,
         slugs=body.slugs,
@@ -162,59 +233,132 @@ def rag_query(body: RAGRequest):
         preload_limit=body.preload_limit,
     )
 
-    base_results = [
+    if not body.include_meta:
+        base_results = [
+            {
+                "chunk_id": ch.id,
+                "document_id": ch.document_id,
+                "score": score,
+                "text": ch.text[:500],
+            }
+            for ch, score in scored
+        ]
+        return {
+            "count": len(base_results),
+            "results": base_results,
+        }
+
+    # title/series уже пришли вместе с чанками — собираем строки за один проход
+    results = [
         {
             "chunk_id": ch.id,
             "document_id": ch.document_id,
             "score": score,
             "text": ch.text[:500],
+            "book_title": ch.book_title,
+            "book_series": ch.book_series,
+            "author": "Валерий Бирюков",
         }
         for ch, score in scored
     ]
 
-    if not body.include_meta:
-        return {
-            "count": len(base_results),
-            "results": base_results,
-        }
-
-    supabase = get_supabase_client()
-    doc_ids = list({row["document_id"] for row in base_results})
-
-    if doc_ids:
-        resp = (
-            supabase.table("documents")
-            .select("id, title, series")
-            .in_("id", doc_ids)
-            .execute()
-        )
-        doc_rows = resp.data or []
-        doc_map = {row["id"]: row for row in doc_rows}
-    else:
-        doc_map = {}
-
-    for row in base_results:
-        doc = doc_map.get(row["document_id"])
-        if doc:
-            row["book_title"] = doc.get("title")
-            row["book_series"] = doc.get("series")
-        else:
-            row["book_title"] = None
-            row["book_series"] = None
-
-        row["author"] = "Валерий Бирюков"
-
     return {
-        "count": len(base_results),
-        "results": base_results,
+        "count": len(results),
+        "results": results,
     }
 
 
 # === ВЫСОКИЙ УРОВЕНЬ: /rag/answer — готовый ответ + цитаты ===
 
+NO_CHUNKS_ANSWER = "В базе не найдено ни одного фрагмента, связанного с запросом."
+
+# Режимы ответа: системный промпт и temperature.
+# Текст пользовательского сообщения — в шаблонах app/prompts/answer_<mode>.j2:
+# неизменная инструкция в начале, фрагменты и вопрос — в конце, чтобы общий
+# префикс запросов был как можно длиннее и попадал в prompt caching OpenAI
+_ANSWER_MODES: Dict[str, Tuple[str, float]] = {
+    "extract": (
+        "Ты отвечаешь ТОЛЬКО на основе переданных фрагментов книг. "
+        "Твоя задача — максимально буквальный, аккуратный ответ. "
+        "Избегай свободных интерпретаций и обобщений, не придумывай того, "
+        "чего нет в текстах. Если данных недостаточно, прямо укажи это. "
+        "Отвечай по-русски, кратко и по существу.",
+        0.1,
+    ),
+    "synthesis": (
+        "Ты отвечаешь ТОЛЬКО на основе переданных фрагментов книг. "
+        "Твоя задача — синтезировать и обобщить идеи из фрагментов, "
+        "но не придумывать факты, которых там нет. "
+        "Можно перефразировать и связывать мысли, но любые выводы должны "
+        "логически следовать из текстов. Если данных недостаточно, прямо скажи об этом. "
+        "Отвечай по-русски, структурированно и без лишней воды.",
+        0.2,
+    ),
+}
+
+# Промпты компилируются один раз при импорте (plain text, без HTML-экранирования)
+_prompt_env = Environment(
+    loader=FileSystemLoader("app/prompts"),
+    autoescape=False,
+    auto_reload=False,
+    cache_size=128,
+)
+_ANSWER_PROMPTS = {
+    mode: _prompt_env.get_template(f"answer_{mode}.j2") for mode in _ANSWER_MODES
+}
+
+# Общий ключ маршрутизации для prompt caching: запросы с одинаковым префиксом
+# попадают на один сервер OpenAI и переиспользуют уже посчитанный префикс
+ANSWER_PROMPT_CACHE_KEY = "rag-answer"
+
+
+def _build_answer_request(
+    body: RAGAnswerRequest,
+    scored: List[Tuple[Chunk, float]],
+) -> Tuple[List[Dict[str, str]], float, List[Dict]]:
+    """
+    Готовит всё для вызова LLM по найденным чанкам:
+    сообщения (system + user), temperature и список цитат.
+    """
+    citations = [
+        {
+            "index": idx,
+            "chunk_id": ch.id,
+            "document_id": ch.document_id,
+            "score": score,
+            "book_title": ch.book_title,
+            "book_series": ch.book_series,
+            "author": "Валерий Бирюков",
+        }
+        for idx, (ch, score) in enumerate(scored, start=1)
+    ]
+
+    mode = body.mode if body.mode in _ANSWER_MODES else "synthesis"
+    system_prompt, temperature = _ANSWER_MODES[mode]
+
+    # title/series документа уже пришли вместе с чанками из retrieve_top_k
+    user_content = _ANSWER_PROMPTS[mode].render(
+        query=body.query,
+        sources=[ch for ch, _score in scored],
+    )
+
+    messages = [
+        {
+            "role": "system",
+            "content": system_prompt,
+        },
+        {
+            "role": "user",
+            "content": user_content,
+        },
+    ]
+
+    return messages, temperature, citations
+
+
 @app.post("/rag/answer")
-def rag_answer(body: RAGAnswerRequest):
-    scored = retrieve_top_k(
+async def rag_answer(body: RAGAnswerRequest):
+    scored = await retrieve_top_k_async(
         query=body.query,
         slug=body.slug,
         slugs=body.slugs,
@@ -224,105 +368,19 @@ def rag_answer(body: RAGAnswerRequest):
 
     if not scored:
         return {
-            "answer": "В базе не найдено ни одного фрагмента, связанного с запросом.",
+            "answer": NO_CHUNKS_ANSWER,
             "citations": [],
         }
 
-    chunks = [ch for ch, _score in scored]
-    doc_ids = list({ch.document_id for ch in chunks})
-
-    supabase = get_supabase_client()
-    doc_meta_resp = (
-        supabase.table("documents")
-        .select("id, title, series")
-        .in_("id", doc_ids)
-        .execute()
-    )
-    meta_rows = doc_meta_resp.data or []
-    meta_by_id = {row["id"]: row for row in meta_rows}
-
-    context_parts: List[str] = []
-    citations = []
-
-    for idx, (ch, score) in enumerate(scored, start=1):
-        meta = meta_by_id.get(ch.document_id, {})
-        book_title = meta.get("title")
-        book_series = meta.get("series")
-
-        context_parts.append(
-            f"Источник {idx}.\n"
-            f"Книга: {book_title or 'неизвестно'}\n"
-            f"Серия: {book_series or 'неизвестно'}\n\n"
-            f"Текст фрагмента:\n{ch.text}"
-        )
-
-        citations.append(
-            {
-                "index": idx,
-                "chunk_id": ch.id,
-                "document_id": ch.document_id,
-                "score": score,
-                "book_title": book_title,
-                "book_series": book_series,
-                "author": "Валерий Бирюков",
-            }
-        )
-
-    context_str = "\n\n---\n\n".join(context_parts)
-
-    mode = body.mode or "synthesis"
-
-    if mode == "extract":
-        system_prompt = (
-            "Ты отвечаешь ТОЛЬКО на основе переданных фрагментов книг. "
-            "Твоя задача — максимально буквальный, аккуратный ответ. "
-            "Избегай свободных интерпретаций и обобщений, не придумывай того, "
-            "чего нет в текстах. Если данных недостаточно, прямо укажи это. "
-            "Отвечай по-русски, кратко и по существу."
-        )
-        user_instruction = (
-            "Сформулируй краткий ответ (3–6 предложений), опираясь на дословные формулировки "
-            "из фрагментов. При необходимости цитируй ключевые фразы. "
-            "Не добавляй собственных гипотез. "
-            "В конце добавь блок «Источники» с перечислением использованных Источников (1, 2, …) "
-            "без пересказа их содержания."
-        )
-        temperature = 0.1
-    else:
-        system_prompt = (
-            "Ты отвечаешь ТОЛЬКО на основе переданных фрагментов книг. "
-            "Твоя задача — синтезировать и обобщить идеи из фрагментов, "
-            "но не придумывать факты, которых там нет. "
-            "Можно перефразировать и связывать мысли, но любые выводы должны "
-            "логически следовать из текстов. Если данных недостаточно, прямо скажи об этом. "
-            "Отвечай по-русски, структурированно и без лишней воды."
-        )
-        user_instruction = (
-            "Сформулируй связный обобщённый ответ на вопрос, аккуратно объединяя идеи из фрагментов. "
-            "Поясни ключевые смыслы и взаимосвязи, но не выходи за рамки того, что явно или неявно "
-            "следует из текстов. "
-            "В конце добавь блок «Источники» с кратким перечислением книг по номерам Источников (1, 2, …)."
-        )
-        temperature = 0.2
+    messages, temperature, citations = _build_answer_request(body, scored)
 
     client = get_openai_client()
-    completion = client.chat.completions.create(
+    completion = await asyncio.to_thread(
+        client.chat.completions.create,
         model="gpt-4.1-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"Вопрос пользователя:\n{body.query}\n\n"
-                    f"Ниже фрагменты из книг (с источниками):\n\n{context_str}\n\n"
-                    f"{user_instruction}"
-                ),
-            },
-        ],
+        messages=messages,
         temperature=temperature,
+        prompt_cache_key=ANSWER_PROMPT_CACHE_KEY,
     )
 
     answer_text = completion.choices[0].message.content
@@ -333,6 +391,62 @@ def rag_answer(body: RAGAnswerRequest):
     }
 
 
+# === /rag/answer/stream — тот же ответ, но потоком (SSE) ===
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.post("/rag/answer/stream")
+async def rag_answer_stream(body: RAGAnswerRequest):
+    """
+    Server-Sent Events:
+      - event: citations — список цитат (сразу после retrieval);
+      - event: delta     — очередной кусок текста ответа {"text": ...};
+      - event: done      — конец ответа.
+    Клиент может показывать источники и текст, не дожидаясь всей генерации.
+    """
+    scored = await retrieve_top_k_async(
+        query=body.query,
+        slug=body.slug,
+        slugs=body.slugs,
+        k=body.top_k,
+        preload_limit=body.preload_limit,
+    )
+
+    if not scored:
+        def generate_empty():
+            yield _sse("citations", [])
+            yield _sse("delta", {"text": NO_CHUNKS_ANSWER})
+            yield _sse("done", {})
+
+        return StreamingResponse(generate_empty(), media_type="text/event-stream")
+
+    messages, temperature, citations = _build_answer_request(body, scored)
+
+    def generate_sse():
+        yield _sse("citations", citations if body.include_meta else [])
+
+        client = get_openai_client()
+        stream = client.chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=messages,
+            temperature=temperature,
+            prompt_cache_key=ANSWER_PROMPT_CACHE_KEY,
+            stream=True,
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield _sse("delta", {"text": delta})
+
+        yield _sse("done", {})
+
+    return StreamingResponse(generate_sse(), media_type="text/event-stream")
+
+
 # === ХЕЛПЕР: построение групп книг для UI ===
 
 SERIES_ORDER: List[str] = [
@@ -371,8 +485,117 @@ TITLE_ORDER: Dict[str, List[str]] = {
     ],
 }
 
+# Позиции серий и заголовков для сортировки за O(1) (вместо list.index)
+SERIES_RANK: Dict[str, int] = {s: i for i, s in enumerate(SERIES_ORDER)}
+TITLE_RANK: Dict[str, Dict[str, int]] = {
+    series: {t: i for i, t in enumerate(titles)}
+    for series, titles in TITLE_ORDER.items()
+}
+
+
+# Кэш групп книг: список документов меняется только после ingest,
+# поэтому не ходим в Supabase на каждый рендер страницы.
+BOOK_GROUPS_TTL_SECONDS = 60
+_book_groups_cache: Dict[str, Any] = {"ts": 0.0, "value": None, "html": {}}
+# render_book_groups_html идёт из пула потоков: чтение, сброс и заполнение
+# _book_groups_cache — только под этой блокировкой
+_book_groups_lock = threading.Lock()
+
+# Сколько вариантов отрендеренного блока книг (по набору выбранных slug) держим в кэше
+BOOK_GROUPS_HTML_CACHE_SIZE = 128
+
+# Общий для всех воркеров на хосте кэш групп книг (gzip JSON в файле),
+# чтобы каждый uvicorn-воркер не ходил в Supabase сам
+BOOK_GROUPS_SHARED_CACHE = Path(tempfile.gettempdir()) / "rag_book_groups.json.gz"
+
+
+def invalidate_book_groups_cache() -> None:
+    """
+    Сбрасывает кэш групп книг (например, после завершения ingest).
+    Действует на память текущего процесса и на общий файл; другие воркеры
+    перечитают группы, когда истечёт их BOOK_GROUPS_TTL_SECONDS.
+    """
+    with _book_groups_lock:
+        _book_groups_cache["ts"] = 0.0
+        _book_groups_cache["value"] = None
+        _book_groups_cache["html"] = {}
+        BOOK_GROUPS_SHARED_CACHE.unlink(missing_ok=True)
+
+
+def _read_shared_book_groups() -> Optional[List[Dict]]:
+    try:
+        age = time.time() - BOOK_GROUPS_SHARED_CACHE.stat().st_mtime
+        if age >= BOOK_GROUPS_TTL_SECONDS:
+            return None
+        return orjson.loads(gzip.decompress(BOOK_GROUPS_SHARED_CACHE.read_bytes()))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_shared_book_groups(book_groups: List[Dict]) -> None:
+    raw = orjson.dumps(book_groups)
+    tmp_path = BOOK_GROUPS_SHARED_CACHE.with_name(
+        f"{BOOK_GROUPS_SHARED_CACHE.name}.{os.getpid()}.tmp"
+    )
+    try:
+        tmp_path.write_bytes(gzip.compress(raw, compresslevel=1))
+        os.replace(tmp_path, BOOK_GROUPS_SHARED_CACHE)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+
 
 def build_book_groups() -> List[Dict]:
+    with _book_groups_lock:
+        return _build_book_groups_locked()
+
+
+def _build_book_groups_locked() -> List[Dict]:
+    # Вызывается под _book_groups_lock: параллельные запросы ждут одну
+    # загрузку из Supabase, а не обновляют кэш каждый сам
+    now = time.monotonic()
+    cached = _book_groups_cache["value"]
+    if cached is not None and now - _book_groups_cache["ts"] < BOOK_GROUPS_TTL_SECONDS:
+        return cached
+
+    book_groups = _read_shared_book_groups()
+    if book_groups is None:
+        book_groups = _load_book_groups()
+        _write_shared_book_groups(book_groups)
+
+    _book_groups_cache["ts"] = now
+    _book_groups_cache["value"] = book_groups
+    _book_groups_cache["html"] = {}
+    return book_groups
+
+
+def render_book_groups_html(selected_slugs: List[str]) -> str:
+    """
+    HTML блока выбора книг. Кэшируется вместе с book_groups (тот же TTL),
+    отдельно для каждого набора отмеченных книг.
+    """
+    key = tuple(sorted(selected_slugs))
+    with _book_groups_lock:
+        book_groups = _build_book_groups_locked()
+        html_cache: Dict[tuple, str] = _book_groups_cache["html"]
+        html = html_cache.get(key)
+    if html is not None:
+        return html
+
+    # шаблон рендерится без блокировки
+    html = templates.get_template("_book_groups.html").render(
+        book_groups=book_groups,
+        selected_slugs=selected_slugs,
+    )
+    with _book_groups_lock:
+        # пока рендерили, кэш могли сбросить — тогда HTML от старых групп не кладём
+        if _book_groups_cache["html"] is html_cache:
+            if len(html_cache) >= BOOK_GROUPS_HTML_CACHE_SIZE:
+                html_cache.clear()
+            html_cache[key] = html
+    return html
+
+
+def _load_book_groups() -> List[Dict]:
     supabase = get_supabase_client()
     resp = (
         supabase.table("documents")
@@ -390,20 +613,16 @@ def build_book_groups() -> List[Dict]:
 
     # порядок серий
     def series_key(s: str) -> int:
-        if s in SERIES_ORDER:
-            return SERIES_ORDER.index(s)
-        return len(SERIES_ORDER) + 1
+        return SERIES_RANK.get(s, len(SERIES_ORDER) + 1)
 
     book_groups: List[Dict] = []
     for series in sorted(by_series.keys(), key=series_key):
         books = by_series[series]
-        order_list = TITLE_ORDER.get(series, [])
+        title_rank = TITLE_RANK.get(series, {})
+        unknown_rank = len(title_rank) + 1
 
         def title_key(b: Dict) -> int:
-            title = b.get("title") or ""
-            if title in order_list:
-                return order_list.index(title)
-            return len(order_list) + 1
+            return title_rank.get(b.get("title") or "", unknown_rank)
 
         books_sorted = sorted(books, key=title_key)
 
@@ -427,7 +646,8 @@ def build_book_groups() -> List[Dict]:
 
 @app.get("/", response_class=HTMLResponse)
 async def index_get(request: Request):
-    book_groups = build_book_groups()
+    # при промахе кэша рендер ходит в Supabase — не блокируем event loop
+    book_groups_html = await asyncio.to_thread(render_book_groups_html, [])
 
     return templates.TemplateResponse(
         "index.html",
@@ -440,7 +660,7 @@ async def index_get(request: Request):
             "mode": "synthesis",
             "answer": None,
             "citations": [],
-            "book_groups": book_groups,
+            "book_groups_html": book_groups_html,
             "selected_slugs": [],
         },
     )
@@ -469,8 +689,12 @@ async def index_post(
         mode=mode or "synthesis",
     )
 
-    resp = rag_answer(body)
-    book_groups = build_book_groups()
+    # rag_answer и блок книг независимы: выполняем их параллельно,
+    # блокирующую сборку блока книг — в потоке, не занимая event loop
+    resp, book_groups_html = await asyncio.gather(
+        rag_answer(body),
+        asyncio.to_thread(render_book_groups_html, selected_slugs),
+    )
 
     return templates.TemplateResponse(
         "index.html",
@@ -483,7 +707,7 @@ async def index_post(
             "mode": mode or "synthesis",
             "answer": resp.get("answer"),
             "citations": resp.get("citations", []),
-            "book_groups": book_groups,
+            "book_groups_html": book_groups_html,
             "selected_slugs": selected_slugs,
         },
     )
\ No newline at end of file
@@ -1,10 +1,8 @@
-import os
 import httpx
-from dotenv import load_dotenv
 
-load_dotenv()
+from app.core.config import settings
 
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TOKEN = settings.TELEGRAM_BOT_TOKEN
 
 if not TOKEN:
     print("ОШИБКА: переменная TELEGRAM_BOT_TOKEN не найдена в .env")
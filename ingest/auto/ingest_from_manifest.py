@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import argparse
+import json
+import os
 import sys
-import yaml
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Any, Dict, List
 
 from loguru import logger
-from app.core.db import get_supabase_client
+from app.core.db import SUPABASE_MAX_CONNECTIONS, get_supabase_client
+from ingest.auto.manifest_io import load_yaml_cached
+from ingest.pipeline import ingest_book_generic
+from ingest.pipeline._common import INSERT_WORKERS
 
 
 # ============================================================
@@ -21,7 +28,7 @@ def load_manifest(path: str = "data/ingest_manifest.yaml") -> List[Dict[str, Any
     if not p.exists():
         raise FileNotFoundError(f"Manifest not found: {path}")
 
-    data = yaml.safe_load(p.read_text(encoding="utf-8"))
+    data = load_yaml_cached(p)
     docs = data.get("documents", [])
     logger.info("Loaded {} document entries from manifest.", len(docs))
     return docs
@@ -31,16 +38,53 @@ def load_manifest(path: str = "data/ingest_manifest.yaml") -> List[Dict[str, Any
 # ПРОВЕРКА НАЛИЧИЯ ФАЙЛОВ
 # ============================================================
 
-def check_files_exist(docs: List[Dict[str, Any]]) -> None:
+# Сайдкар-кэш (mtime_ns, size) по файлам манифеста с прошлой проверки
+FILES_CACHE_PATH = Path("data/.ingest_manifest.cache.json")
+
+
+def _load_files_cache(path: Path) -> Dict[str, List[int]]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def check_files_exist(docs: List[Dict[str, Any]], cache_path: Path = FILES_CACHE_PATH) -> None:
+    """
+    Проверяет, что все файлы манифеста на месте: один os.stat на файл.
+    Подробно логируются только новые/изменённые с прошлой проверки файлы,
+    неизменённые — одной итоговой строкой.
+    """
+    cache = _load_files_cache(cache_path)
+    updated = dict(cache)
+    unchanged = 0
+
     for d in docs:
         doc_id = d["id"]
         file_path = d["file"]
-        if Path(file_path).exists():
-            logger.info("[FILES] OK   – {}: {}", doc_id, file_path)
-        else:
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
             logger.error("[FILES] MISSING – {}: {}", doc_id, file_path)
             raise FileNotFoundError(f"Missing file: {file_path}")
 
+        signature = [st.st_mtime_ns, st.st_size]
+        if cache.get(file_path) == signature:
+            unchanged += 1
+            continue
+
+        updated[file_path] = signature
+        logger.info("[FILES] OK   – {}: {}", doc_id, file_path)
+
+    if unchanged:
+        logger.info("[FILES] OK   – {} files unchanged since last check.", unchanged)
+
+    if updated != cache:
+        try:
+            cache_path.write_text(json.dumps(updated, ensure_ascii=False), encoding="utf-8")
+        except OSError as e:
+            logger.warning("[FILES] Could not write files cache {}: {}", cache_path, e)
+
 
 # ============================================================
 # ПРОВЕРКА В SUPABASE
@@ -52,21 +96,27 @@ def check_in_supabase(client, docs: List[Dict[str, Any]]) -> Dict[str, Dict[str,
        { slug: {"exists": bool, "id":..., "version":...} }
     """
     out = {}
+    if not docs:
+        return out
+
+    # Один запрос на все slug'и вместо отдельного запроса на каждый документ
+    slugs = list({d["slug"] for d in docs})
+    logger.info("[SUPABASE] Checking {} document slugs in one query...", len(slugs))
+
+    resp = (
+        client.table("documents")
+        .select("id, slug, version, updated_at")
+        .in_("slug", slugs)
+        .execute()
+    )
+    existing = {(r["slug"], int(r["version"])): r for r in resp.data or []}
+
     for d in docs:
         slug = d["slug"]
-        version = d.get("version", 1) or 1
-        logger.info("[SUPABASE] Checking document slug={}, version={}...", slug, version)
-
-        resp = (
-            client.table("documents")
-            .select("*")
-            .eq("slug", slug)
-            .eq("version", version)
-            .execute()
-        )
+        version = int(d.get("version", 1) or 1)
+        row = existing.get((slug, version))
 
-        if resp.data:
-            row = resp.data[0]
+        if row:
             logger.info(
                 "[SUPABASE] EXISTS – {}: id={}, version={}, updated_at={}",
                 d["id"],
@@ -86,9 +136,44 @@ def check_in_supabase(client, docs: List[Dict[str, Any]]) -> Dict[str, Dict[str,
 # ЗАПУСК INGEST ПРОЦЕССА
 # ============================================================
 
-def run_ingest_for_doc(doc: Dict[str, Any]) -> None:
+def run_ingest_for_doc(doc: Dict[str, Any], isolated: bool = False) -> None:
     """
     Запускает pipeline для одного документа.
+
+    По умолчанию — в текущем процессе (импорты и клиент Supabase
+    переиспользуются между документами). С isolated=True — как раньше,
+    отдельным процессом python -m ... (изоляция падений).
+    """
+    if isolated:
+        _run_ingest_subprocess(doc)
+        return
+
+    doc_id = doc["id"]
+    slug = doc["slug"]
+    version = int(doc.get("version", 1) or 1)
+
+    if not doc.get("title"):
+        raise ValueError(f"Manifest entry {doc_id} has no title")
+
+    args = argparse.Namespace(
+        file=doc["file"],
+        slug=slug,
+        title=doc["title"],
+        subtitle=doc.get("subtitle") or None,
+        series=doc.get("series") or None,
+        doc_type="книга",
+        version=version,
+        language=doc.get("language") or "ru",
+    )
+
+    logger.info("[INGEST] In-process ingest for {} (slug={}, version={})", doc_id, slug, version)
+    ingest_book_generic.run(args)
+    logger.info("[INGEST] Finished for {} (slug={}, version={})", doc_id, slug, version)
+
+
+def _run_ingest_subprocess(doc: Dict[str, Any]) -> None:
+    """
+    Запускает pipeline для одного документа отдельным процессом.
     Гарантия: никаких None в команду не попадает.
     """
 
@@ -98,7 +183,6 @@ def run_ingest_for_doc(doc: Dict[str, Any]) -> None:
 
     version = str(doc.get("version", 1) or 1)
     language = doc.get("language") or "ru"
-    doc_type = (doc.get("doc_type") or "book").lower()
 
     module = "ingest.pipeline.ingest_book_generic"
 
@@ -145,6 +229,8 @@ def ingest_from_manifest(
     manifest_path: str,
     mode: str,
     ids: List[str] | None = None,
+    isolated: bool = False,
+    workers: int = 4,
 ) -> None:
 
     logger.info("Starting ingest_from_manifest (mode={})...", mode)
@@ -180,8 +266,26 @@ def ingest_from_manifest(
             len(docs),
         )
 
-        for d in new_docs:
-            run_ingest_for_doc(d)
+        # Ingest в основном ждёт сеть (Supabase), поэтому документы идут
+        # параллельно в ограниченном пуле потоков. В одном процессе у каждого
+        # документа ещё INSERT_WORKERS потоков вставки на общем пуле соединений
+        # Supabase — документов одновременно не больше, чем этот пул вмещает.
+        # С --isolated у каждого процесса свой пул (и свой лимит embeddings,
+        # INGEST_EMBED_CONCURRENCY на процесс).
+        max_workers = max(1, min(workers, len(new_docs)))
+        if not isolated:
+            pool_workers = max(1, SUPABASE_MAX_CONNECTIONS // INSERT_WORKERS)
+            if max_workers > pool_workers:
+                logger.warning(
+                    "workers={} × INSERT_WORKERS={} exceeds Supabase pool ({}), using {} workers",
+                    max_workers,
+                    INSERT_WORKERS,
+                    SUPABASE_MAX_CONNECTIONS,
+                    pool_workers,
+                )
+                max_workers = pool_workers
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            list(ex.map(partial(run_ingest_for_doc, isolated=isolated), new_docs))
         return
 
     raise ValueError(f"Invalid mode: {mode}")
@@ -192,8 +296,6 @@ def ingest_from_manifest(
 # ============================================================
 
 def main():
-    import argparse
-
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -216,12 +318,27 @@ def main():
         help="Ограничить запуск документами по их id или slug.",
     )
 
+    parser.add_argument(
+        "--isolated",
+        action="store_true",
+        help="Запускать ingest каждого документа отдельным процессом (изоляция падений).",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Сколько документов ингестить параллельно (по умолчанию 4).",
+    )
+
     args = parser.parse_args()
 
     ingest_from_manifest(
         manifest_path=args.manifest,
         mode=args.mode,
         ids=args.ids,
+        isolated=args.isolated,
+        workers=args.workers,
     )
 
 
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict
+
+import yaml
+from loguru import logger
+
+# C-ускоренные loader/dumper из libyaml, если PyYAML собран с ними
+_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def _cache_path(p: Path) -> Path:
+    # data/ingest_manifest.yaml -> data/ingest_manifest.cache.pkl
+    return p.with_suffix(".cache.pkl")
+
+
+def _signature(p: Path) -> tuple[int, int]:
+    st = p.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+def _write_cache(p: Path, data: Dict[str, Any]) -> None:
+    cache_path = _cache_path(p)
+    try:
+        with cache_path.open("wb") as f:
+            pickle.dump(
+                {"signature": _signature(p), "data": data},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except OSError as e:
+        logger.warning("Could not write manifest cache {}: {}", cache_path, e)
+
+
+def load_yaml_cached(p: Path) -> Dict[str, Any]:
+    """
+    Парсит YAML манифеста, кэшируя результат в pickle рядом с ним
+    (data/ingest_manifest.cache.pkl). Кэш валиден, пока не изменились
+    mtime/размер YAML-файла. Каждый вызов отдаёт свою копию данных,
+    так что вызывающий код может их менять.
+    """
+    signature = _signature(p)
+
+    try:
+        with _cache_path(p).open("rb") as f:
+            cached = pickle.load(f)
+        if cached.get("signature") == signature:
+            return cached["data"]
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError):
+        pass
+
+    data = yaml.load(p.read_text(encoding="utf-8"), Loader=_LOADER) or {}
+    _write_cache(p, data)
+    return data
+
+
+def save_yaml(p: Path, data: Dict[str, Any]) -> None:
+    """
+    Сохраняет манифест (CSafeDumper, формат как у yaml.safe_dump)
+    и сразу обновляет pickle-кэш под новый mtime файла.
+    Пишем во временный файл рядом и подменяем через os.replace:
+    прерванный запуск не оставит обрезанный YAML.
+    """
+    tmp_path = p.with_name(p.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        yaml.dump(
+            data,
+            f,
+            Dumper=_DUMPER,
+            allow_unicode=True,
+            sort_keys=False,
+            default_flow_style=False,
+        )
+    os.replace(tmp_path, p)
+    _write_cache(p, data)
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple, Any
 
-import yaml
+from ingest.auto.manifest_io import load_yaml_cached, save_yaml
 
 # Корень RAW-папки
 RAW_ROOT = Path("data/raw")
@@ -17,14 +19,16 @@ ALLOWED_SUFFIXES = {".docx", ".pptx", ".ppt", ".pdf"}
 # Приоритет расширений в одной группе (stem)
 PREFERRED_SUFFIX_ORDER = [".docx", ".pptx", ".ppt", ".pdf"]
 
+# Сколько папок сканируем параллельно (os.scandir отпускает GIL)
+SCAN_WORKERS = 8
+
 
 def load_manifest() -> List[Dict[str, Any]]:
     """Загружаем список документов из ingest_manifest.yaml."""
     if not MANIFEST_PATH.exists():
         return []
 
-    with MANIFEST_PATH.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
+    data = load_yaml_cached(MANIFEST_PATH)
 
     docs = data.get("documents", [])
     if not isinstance(docs, list):
@@ -34,18 +38,35 @@ def load_manifest() -> List[Dict[str, Any]]:
 
 def save_manifest(docs: List[Dict[str, Any]]) -> None:
     """Сохраняем список документов обратно в ingest_manifest.yaml."""
-    data = {"documents": docs}
-    with MANIFEST_PATH.open("w", encoding="utf-8") as f:
-        yaml.safe_dump(
-            data,
-            f,
-            allow_unicode=True,
-            sort_keys=False,
-            default_flow_style=False,
-        )
-
-
-def collect_file_groups(raw_root: Path) -> Dict[str, Dict[str, Path]]:
+    save_yaml(MANIFEST_PATH, {"documents": docs})
+
+
+def scan_one_dir(dir_path: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Один уровень обхода: читаем папку через os.scandir.
+    Возвращаем (файлы с допустимым расширением как (path, suffix), подпапки).
+    DirEntry кэширует тип записи, лишних stat не делаем.
+    """
+    files: List[Tuple[str, str]] = []
+    subdirs: List[str] = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            suffix = os.path.splitext(entry.name)[1].lower()
+            if suffix in ALLOWED_SUFFIXES:
+                files.append((entry.path, suffix))
+    return files, subdirs
+
+
+def collect_file_groups(
+    raw_root: Path,
+    max_workers: int = SCAN_WORKERS,
+) -> Dict[str, Dict[str, Path]]:
     """
     Рекурсивно обходим data/raw, собираем файлы с допустимыми расширениями
     и группируем по "stem-ключу".
@@ -58,26 +79,44 @@ def collect_file_groups(raw_root: Path) -> Dict[str, Dict[str, Path]]:
     Это значит:
       - файлы в разных подпапках с одинаковым именем считаются разными группами;
       - внутри одной группы (.docx / .pptx / .pdf) выбираем по приоритету.
+
+    Папки читаем в ThreadPoolExecutor уровнями (BFS): на сетевом диске
+    или холодном кэше обход упирается в задержки syscalls, а не в CPU.
+    Группы затем собираем в порядке обхода в глубину — как раньше с rglob.
     """
+    root = str(raw_root)
+    scanned: Dict[str, Tuple[List[Tuple[str, str]], List[str]]] = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        level = [root]
+        while level:
+            results = list(executor.map(scan_one_dir, level))
+            scanned.update(zip(level, results))
+            level = [sub for _, subdirs in results for sub in subdirs]
+
     groups: Dict[str, Dict[str, Path]] = {}
 
-    for path in raw_root.rglob("*"):
-        if not path.is_file():
-            continue
+    # entry.path всегда начинается с root + разделитель — относительный путь
+    # и stem_key получаем срезом строки, без relative_to/with_suffix
+    root_prefix_len = len(os.path.join(root, ""))
 
-        suffix = path.suffix.lower()
-        if suffix not in ALLOWED_SUFFIXES:
-            continue
+    stack: List[str] = [root]
+    while stack:
+        files, subdirs = scanned[stack.pop()]
+        for file_path, suffix in files:
+            # относительный путь от RAW_ROOT, например "sub/Test-RAG.docx"
+            rel = file_path[root_prefix_len:]
+            # ключ группы — относительный путь БЕЗ расширения
+            stem_key = rel[: -len(suffix)]  # "sub/Test-RAG" или "Test-RAG"
+            path = Path(file_path)
 
-        # относительный путь от RAW_ROOT
-        rel = path.relative_to(raw_root)  # например "sub/Test-RAG.docx"
-        # ключ группы — относительный путь БЕЗ расширения
-        stem_key = str(rel.with_suffix(""))  # "sub/Test-RAG" или "Test-RAG"
+            if stem_key not in groups:
+                groups[stem_key] = {}
+            # в рамках stem_key храним файлы по расширению
+            groups[stem_key][suffix] = path
 
-        if stem_key not in groups:
-            groups[stem_key] = {}
-        # в рамках stem_key храним файлы по расширению
-        groups[stem_key][suffix] = path
+        # в обратном порядке, чтобы подпапки обходились в порядке scandir
+        stack.extend(reversed(subdirs))
 
     return groups
 
@@ -123,11 +162,22 @@ def sync_with_manifest(
     # Множество путей файлов, которые есть на диске (с учётом выбора по расширению)
     disk_file_paths = {str(path) for path in chosen_files.values()}
 
-    # Множество путей файлов, которые уже в манифесте
-    existing_files = {doc.get("file") for doc in manifest_docs if doc.get("file")}
+    # Один проход по манифесту:
+    #  - собираем множество путей файлов, которые уже в манифесте;
+    #  - помечаем как archived записи, у которых файл исчез с диска.
+    existing_files: set[str] = set()
+    archived_count = 0
+    for doc in manifest_docs:
+        f = doc.get("file")
+        if not f:
+            continue
+        existing_files.add(f)
+        if f not in disk_file_paths and doc.get("status") != "archived":
+            doc["status"] = "archived"
+            archived_count += 1
 
     # 1) считаем, сколько из выбранных файлов уже отражены в манифесте
-    already_known = sum(1 for f in disk_file_paths if f in existing_files)
+    already_known = len(disk_file_paths & existing_files)
 
     # 2) добавляем новые записи (те, которых нет в манифесте по полю file)
     new_docs: List[Dict[str, Any]] = []
@@ -155,21 +205,11 @@ def sync_with_manifest(
 
     new_count = len(new_docs)
 
-    # 3) помечаем как archived те записи манифеста, у которых файл исчез с диска
-    archived_count = 0
-    for doc in manifest_docs:
-        f = doc.get("file")
-        if not f:
-            continue
-        if f not in disk_file_paths and doc.get("status") != "archived":
-            doc["status"] = "archived"
-            archived_count += 1
-
-    # Если не dry_run — физически дописываем новые документы и сохраняем YAML
-    if not dry_run:
-        if new_docs or archived_count:
-            manifest_docs.extend(new_docs)
-            save_manifest(manifest_docs)
+    # Если не dry_run — физически дописываем новые документы и сохраняем YAML.
+    # Без новых и archived записей манифест не трогаем вовсе.
+    if not dry_run and (new_docs or archived_count):
+        manifest_docs.extend(new_docs)
+        save_manifest(manifest_docs)
 
     return total_groups, already_known, new_count, archived_count
 
@@ -206,8 +246,10 @@ def main() -> None:
 
     if args.dry_run:
         print("[SCAN] Режим dry-run: манифест НЕ будет изменён.")
-    else:
+    elif new_count or archived_count:
         print("[SCAN] Манифест ОБНОВЛЁН.")
+    else:
+        print("[SCAN] Изменений нет: манифест не перезаписывался.")
 
 
 if __name__ == "__main__":
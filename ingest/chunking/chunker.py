@@ -2,125 +2,101 @@ from __future__ import annotations
 
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional, Union, Any
+from typing import Iterable, Iterator, List, Optional
 
 from loguru import logger
 
 from ingest.extract_text.docx_reader import Block, extract_blocks_from_docx, debug_print_blocks
 
 
-# Универсальный тип блока: либо dataclass Block, либо dict
-BlockLike = Union[Block, dict[str, Any]]
-
-
-def _get_block_text(block: BlockLike) -> str:
-    """Безопасно достаёт текст блока для Block и dict."""
-    if hasattr(block, "text"):
-        return (getattr(block, "text") or "").strip()
-    if isinstance(block, dict):
-        return (block.get("text") or "").strip()
-    return str(block).strip()
-
-
-def _get_block_level(block: BlockLike) -> Optional[int]:
-    """Безопасно достаёт уровень заголовка (level), если он есть."""
-    if hasattr(block, "level"):
-        return getattr(block, "level")
-    if isinstance(block, dict):
-        return block.get("level")
-    return None
-
-
-def _get_block_type(block: BlockLike) -> str:
-    """Тип блока для отладки (heading/paragraph и т.п.)."""
-    if hasattr(block, "type"):
-        return str(getattr(block, "type"))
-    if isinstance(block, dict):
-        return str(block.get("type", "unknown"))
-    return type(block).__name__
-
-
 @dataclass
 class Section:
     """
     Логический раздел книги.
     В идеале соответствует заголовку H1, но при отсутствии H1
     умеет представлять весь документ как одну секцию.
+
+    Блоки секции хранятся параллельными списками (texts[i], levels[i]),
+    а не объектами-блоками: чанкеру нужен только текст, и он берёт его
+    напрямую, без разбора типа каждого блока.
     """
     index: int                             # порядковый номер секции (1..N)
     title: str                             # текст заголовка секции
-    heading_block: Optional[BlockLike]     # сам блок заголовка (или None, если fallback)
-    blocks: List[BlockLike] = field(default_factory=list)  # все блоки внутри секции
+    texts: List[str] = field(default_factory=list)             # тексты блоков (включая сам H1)
+    levels: List[Optional[int]] = field(default_factory=list)  # уровень заголовка блока, None — абзац
 
 
-def split_into_sections(blocks: List[BlockLike]) -> List[Section]:
+def iter_sections(blocks: Iterable[Block]) -> Iterator[Section]:
     """
-    Разбивает последовательность блоков на секции.
+    Потоково разбивает последовательность блоков на секции.
 
     Логика:
     - Если есть блоки с level == 1 → каждая H1 открывает новую секцию.
     - Все блоки между H1 относятся к соответствующей секции.
-    - Если ни одного H1 нет → создаём одну секцию из всего документа
+    - Если ни одного H1 нет → отдаём одну секцию из всего документа
       (fallback для неструктурированных файлов).
+
+    Блоки — как их отдаёт docx_reader: текст уже очищен от пробелов и не пустой.
+    В памяти держится только текущая секция.
     """
-    sections: List[Section] = []
     has_h1 = False
 
-    current_blocks: List[BlockLike] = []
+    current_texts: List[str] = []
+    current_levels: List[Optional[int]] = []
     current_title: Optional[str] = None
-    current_heading_block: Optional[BlockLike] = None
     current_index = 0
 
     for block in blocks:
-        level = _get_block_level(block)
+        level = block["level"]
+        text = block["text"]
 
         if level == 1:
             has_h1 = True
 
             # закрываем предыдущую секцию, если она была
-            if current_blocks:
-                sections.append(
-                    Section(
-                        index=current_index,
-                        title=current_title or "",
-                        heading_block=current_heading_block,
-                        blocks=current_blocks,
-                    )
+            if current_texts:
+                yield Section(
+                    index=current_index,
+                    title=current_title or "",
+                    texts=current_texts,
+                    levels=current_levels,
                 )
 
             # открываем новую секцию
             current_index += 1
-            current_heading_block = block
-            title_text = _get_block_text(block)
-            current_title = title_text or f"Section {current_index}"
-            current_blocks = [block]
+            current_title = text or f"Section {current_index}"
+            current_texts = [text]
+            current_levels = [level]
         else:
             # просто накапливаем контент
-            current_blocks.append(block)
+            current_texts.append(text)
+            current_levels.append(level)
 
     # добиваем хвост
-    if current_blocks:
+    if current_texts:
         if has_h1:
             # нормальный случай: последняя секция с H1
-            sections.append(
-                Section(
-                    index=current_index,
-                    title=current_title or "",
-                    heading_block=current_heading_block,
-                    blocks=current_blocks,
-                )
+            yield Section(
+                index=current_index,
+                title=current_title or "",
+                texts=current_texts,
+                levels=current_levels,
             )
         else:
             # fallback: ни одного H1, весь документ — одна секция
-            first_text = _get_block_text(blocks[0]) if blocks else ""
-            sections = [
-                Section(
-                    index=1,
-                    title=first_text or "FULL_DOCUMENT",
-                    heading_block=None,
-                    blocks=blocks,
-                )
-            ]
+            yield Section(
+                index=1,
+                title=current_texts[0] or "FULL_DOCUMENT",
+                texts=current_texts,
+                levels=current_levels,
+            )
+
+
+def split_into_sections(blocks: Iterable[Block]) -> List[Section]:
+    """
+    То же, что iter_sections, но сразу списком.
+    """
+    sections = list(iter_sections(blocks))
 
     logger.info(
         "Split into %d sections (H1-based if present, fallback to single FULL_DOCUMENT)",
@@ -129,6 +105,11 @@ def split_into_sections(blocks: List[BlockLike]) -> List[Section]:
     return sections
 
 
+def _block_type(level: Optional[int]) -> str:
+    """Тип блока для отладки (heading/paragraph)."""
+    return "paragraph" if level is None else "heading"
+
+
 def debug_print_sections(sections: List[Section], limit: int = 20) -> None:
     """
     Печатает краткий обзор первых N секций:
@@ -141,19 +122,56 @@ def debug_print_sections(sections: List[Section], limit: int = 20) -> None:
     for s in sections[:limit]:
         print("=" * 80)
         print(f"SECTION {s.index}: {s.title}")
-        print(f"Blocks inside: {len(s.blocks)}")
-        if s.blocks:
-            b0 = s.blocks[0]
-            preview = _get_block_text(b0)
+        print(f"Blocks inside: {len(s.texts)}")
+        if s.texts:
+            preview = s.texts[0]
             if len(preview) > 100:
                 preview = preview[:97] + "..."
-            print(f"  First block: [{_get_block_type(b0)}] {preview}")
-        if len(s.blocks) > 1:
-            b1 = s.blocks[1]
-            preview2 = _get_block_text(b1)
+            print(f"  First block: [{_block_type(s.levels[0])}] {preview}")
+        if len(s.texts) > 1:
+            preview2 = s.texts[1]
             if len(preview2) > 100:
                 preview2 = preview2[:97] + "..."
-            print(f"  Second block: [{_get_block_type(b1)}] {preview2}")
+            print(f"  Second block: [{_block_type(s.levels[1])}] {preview2}")
+
+
+def plan_chunks(
+    lengths: List[int],
+    max_chars: int = 1200,
+    min_chars: int = 600,
+) -> List[List[int]]:
+    """
+    Планирует границы чанков только по длинам кусков текста.
+    Возвращает срезы [start, end) по списку кусков — строки собирает вызывающий код,
+    каждый чанк одной операцией join, без повторного копирования.
+
+    - куски добавляются через "\n\n" (+2 к длине, если в чанке уже есть текст);
+    - как только длина > max_chars — фиксируем chunk и начинаем новый;
+    - хвост < min_chars, если есть предыдущий chunk — приклеиваем к нему.
+    """
+    bounds: List[List[int]] = []
+    start = 0
+    current_len = 0
+
+    for i, length in enumerate(lengths):
+        # +2 за "\n\n", если в текущем чанке уже есть текст
+        extra_len = length + (2 if i > start else 0)
+        if current_len + extra_len > max_chars and i > start:
+            bounds.append([start, i])
+            start = i
+            current_len = 0
+        current_len += extra_len
+
+    # Хвост
+    n = len(lengths)
+    tail_len = sum(lengths[start:]) + 2 * (n - start - 1)
+    if bounds and tail_len < min_chars:
+        # маленький хвост — приклеиваем к предыдущему чанку
+        bounds[-1][1] = n
+    else:
+        bounds.append([start, n])
+
+    return bounds
 
 
 def build_text_chunks_for_section(
@@ -169,59 +187,34 @@ def build_text_chunks_for_section(
     - как только длина буфера > max_chars — фиксируем chunk и начинаем новый;
     - хвост < min_chars, если есть предыдущий chunk — приклеиваем к нему.
     В каждый chunk в начало добавляем заголовок секции (H1), чтобы не потерять контекст.
-
-    Работает и с Block, и с dict-блоками.
     """
-    pieces: List[str] = []
-
     # Заголовок секции как первый контекстный блок
     header = section.title.strip()
 
-    for b in section.blocks:
-        txt = _get_block_text(b)
-        if not txt:
-            continue
-        pieces.append(txt)
+    # тексты блоков секции уже очищены и не пустые — берём список как есть
+    pieces = section.texts
 
     if not pieces:
         # Пустая секция — либо пропускаем, либо один короткий chunk только с заголовком
         return [header] if header else []
 
-    chunks: List[str] = []
-    current: List[str] = []
-    current_len = 0
+    bounds = plan_chunks([len(p) for p in pieces], max_chars=max_chars, min_chars=min_chars)
 
-    def flush_current() -> None:
-        nonlocal current, current_len
-        if not current:
-            return
-        body = "\n\n".join(current)
-        if header:
-            full_text = header + "\n\n" + body
-        else:
-            full_text = body
-        chunks.append(full_text)
-        current = []
-        current_len = 0
-
-    for piece in pieces:
-        # +2 за "\n\n", если в current уже есть текст
-        extra_len = len(piece) + (2 if current else 0)
-        if current_len + extra_len > max_chars and current:
-            flush_current()
-        current.append(piece)
-        current_len += extra_len
+    prefix = header + "\n\n" if header else ""
+    return [prefix + "\n\n".join(pieces[a:b]) for a, b in bounds]
 
-    # Хвост
-    if current:
-        tail_text = "\n\n".join(current)
-        if chunks and len(tail_text) < min_chars:
-            # маленький хвост — приклеиваем к предыдущему чанку
-            chunks[-1] = chunks[-1] + "\n\n" + tail_text
-        else:
-            flush_current()
 
-    return chunks
+def iter_text_chunks(
+    sections: Iterable[Section],
+    max_chars: int = 1200,
+    min_chars: int = 600,
+) -> Iterator[str]:
+    """
+    Потоково отдаёт текстовые чанки по всем секциям
+    (build_text_chunks_for_section для каждой секции по очереди).
+    """
+    for section in sections:
+        yield from build_text_chunks_for_section(section, max_chars=max_chars, min_chars=min_chars)
 
 
 if __name__ == "__main__":
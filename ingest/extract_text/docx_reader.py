@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Literal, TypedDict, List
+from typing import Dict, Iterator, Literal, TypedDict, List
 
 import re
-from docx import Document
+import zipfile
+
+from lxml import etree
 from loguru import logger
 
 
@@ -17,6 +19,14 @@ class Block(TypedDict, total=False):
     text: str
 
 
+# Кэш "имя стиля -> уровень заголовка": различных стилей в документе
+# единицы-десятки, а абзацев — тысячи
+_HEADING_CACHE: dict[str, int | None] = {}
+
+# \s* покрывает и "Heading 1", и "Heading1" — одного регулярного выражения достаточно
+_HEADING_RE = re.compile(r"(?:heading|заголовок)\s*(\d+)")
+
+
 def detect_heading_level(style_name: str | None) -> int | None:
     """
     Определяет уровень заголовка по имени стиля Word.
@@ -27,77 +37,165 @@ def detect_heading_level(style_name: str | None) -> int | None:
     if not style_name:
         return None
 
-    name = style_name.strip().lower()
+    try:
+        return _HEADING_CACHE[style_name]
+    except KeyError:
+        pass
 
-    # Варианты "heading 1", "заголовок 1"
-    m = re.match(r"(heading|заголовок)\s*(\d+)", name)
-    if m:
-        try:
-            return int(m.group(2))
-        except ValueError:
-            return None
+    level = _parse_heading_level(style_name)
+    _HEADING_CACHE[style_name] = level
+    return level
 
-    # Иногда стили называются просто "Heading1" / "Заголовок1"
-    m2 = re.match(r"(heading|заголовок)(\d+)", name)
-    if m2:
-        try:
-            return int(m2.group(2))
-        except ValueError:
-            return None
 
-    return None
+def _parse_heading_level(style_name: str) -> int | None:
+    # "heading 1", "заголовок 1", а также слитно "Heading1" / "Заголовок1"
+    m = _HEADING_RE.match(style_name.strip().lower())
+    return int(m.group(1)) if m else None
 
 
-def extract_blocks_from_docx(path: str | Path) -> List[Block]:
+# Пространство имён WordprocessingML
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_W = f"{{{_W_NS}}}"
+
+_W_BODY = f"{_W}body"
+_W_P = f"{_W}p"
+_W_R = f"{_W}r"
+_W_HYPERLINK = f"{_W}hyperlink"
+_W_VAL = f"{_W}val"
+_W_TYPE = f"{_W}type"
+_W_STYLE_ID = f"{_W}styleId"
+
+# Узлы верхнего уровня w:body, после которых можно освобождать память
+_BODY_CHILD_TAGS = (_W_P, f"{_W}tbl", f"{_W}sdt")
+
+# Текстовые элементы внутри w:r (как их понимает python-docx)
+_W_T = f"{_W}t"
+_W_TAB = f"{_W}tab"
+_W_PTAB = f"{_W}ptab"
+_W_BR = f"{_W}br"
+_W_CR = f"{_W}cr"
+_W_NO_BREAK_HYPHEN = f"{_W}noBreakHyphen"
+
+
+def _load_heading_levels(zf: zipfile.ZipFile) -> Dict[str, int]:
+    """
+    styleId -> уровень заголовка по word/styles.xml (только заголовочные стили).
+    В русском Word id заголовка часто "1", а имя — "heading 1",
+    поэтому уровень определяем именно по имени — один раз на стиль,
+    а для абзацев остаётся только поиск по styleId в словаре.
+    """
+    try:
+        data = zf.read("word/styles.xml")
+    except KeyError:
+        return {}
+
+    root = etree.fromstring(data)
+    levels: Dict[str, int] = {}
+    for style in root.iterfind(f"{_W}style"):
+        style_id = style.get(_W_STYLE_ID)
+        name_el = style.find(f"{_W}name")
+        if style_id is None or name_el is None:
+            continue
+        level = detect_heading_level(name_el.get(_W_VAL) or "")
+        if level is not None:
+            levels[style_id] = level
+    return levels
+
+
+def _run_text(run: etree._Element) -> str:
+    parts: List[str] = []
+    for child in run:
+        tag = child.tag
+        if tag == _W_T:
+            parts.append(child.text or "")
+        elif tag == _W_TAB or tag == _W_PTAB:
+            parts.append("\t")
+        elif tag == _W_BR:
+            if child.get(_W_TYPE) in (None, "textWrapping"):
+                parts.append("\n")
+        elif tag == _W_CR:
+            parts.append("\n")
+        elif tag == _W_NO_BREAK_HYPHEN:
+            parts.append("-")
+    return "".join(parts)
+
+
+def _paragraph_text(p: etree._Element) -> str:
+    """Текст абзаца: прямые w:r и w:r внутри w:hyperlink (как Paragraph.text)."""
+    parts: List[str] = []
+    for child in p:
+        if child.tag == _W_R:
+            parts.append(_run_text(child))
+        elif child.tag == _W_HYPERLINK:
+            for run in child.iterfind(_W_R):
+                parts.append(_run_text(run))
+    return "".join(parts)
+
+
+def iter_blocks_from_docx(path: str | Path) -> Iterator[Block]:
     """
-    Читает DOCX и возвращает список блоков:
+    Потоково читает DOCX и отдаёт блоки по одному:
     - заголовки (type='heading', level=1/2/3...)
     - обычные абзацы (type='paragraph')
     Пустые строки выбрасываются.
+
+    word/document.xml читается через lxml.iterparse без построения
+    объектной модели python-docx; учитываются только абзацы верхнего
+    уровня w:body (как doc.paragraphs), обработанные узлы сразу освобождаются.
     """
     path = Path(path)
     if not path.exists():
         raise FileNotFoundError(f"DOCX file not found: {path}")
 
     logger.info(f"Loading DOCX: {path}")
-    doc = Document(path)
 
-    blocks: List[Block] = []
+    count = 0
 
-    for p in doc.paragraphs:
-        text = p.text.strip()
-        if not text:
-            continue  # пропускаем пустые абзацы
+    with zipfile.ZipFile(path) as zf:
+        heading_levels = _load_heading_levels(zf)
 
-        style_name = None
-        try:
-            if p.style is not None and p.style.name:
-                style_name = str(p.style.name)
-        except Exception:
-            # иногда у стиля бывают странные состояния — просто игнорируем
-            style_name = None
+        with zf.open("word/document.xml") as stream:
+            for _event, elem in etree.iterparse(stream, events=("end",), tag=_BODY_CHILD_TAGS):
+                parent = elem.getparent()
+                if parent is None or parent.tag != _W_BODY:
+                    continue
 
-        level = detect_heading_level(style_name)
+                if elem.tag == _W_P:
+                    text = _paragraph_text(elem).strip()
+                    if text:
+                        p_style = elem.find(f"{_W}pPr/{_W}pStyle")
+                        level = None
+                        if p_style is not None:
+                            level = heading_levels.get(p_style.get(_W_VAL) or "")
 
-        if level is not None:
-            blocks.append(
-                Block(
-                    type="heading",
-                    level=level,
-                    text=text,
-                )
-            )
-        else:
-            blocks.append(
-                Block(
-                    type="paragraph",
-                    level=None,
-                    text=text,
-                )
-            )
-
-    logger.info(f"Extracted {len(blocks)} blocks from DOCX")
-    return blocks
+                        count += 1
+
+                        if level is not None:
+                            yield Block(
+                                type="heading",
+                                level=level,
+                                text=text,
+                            )
+                        else:
+                            yield Block(
+                                type="paragraph",
+                                level=None,
+                                text=text,
+                            )
+
+                # узел верхнего уровня обработан — освобождаем память
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+    logger.info(f"Extracted {count} blocks from DOCX")
+
+
+def extract_blocks_from_docx(path: str | Path) -> List[Block]:
+    """
+    То же, что iter_blocks_from_docx, но сразу списком.
+    """
+    return list(iter_blocks_from_docx(path))
 
 
 def debug_print_blocks(blocks: List[Block], limit: int = 40) -> None:
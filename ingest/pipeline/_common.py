@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+# Общие шаги ingest книги в Supabase (documents/sections/chunks)
+# для ingest_book_generic.py и ingest_book_strateg_intellect.py
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+import threading
+from typing import List, Optional, Set
+
+from loguru import logger
+from openai import OpenAIError
+from postgrest import APIError
+from supabase import Client
+
+from app.core.config import settings
+from app.core.db import MISSING_FUNCTION_ERROR_CODES
+from ingest.pipeline.build_embeddings import EMBEDDING_MODEL, to_halfvec_literal
+from rag.embedding import embed_texts
+from ingest.chunking.chunker import build_text_chunks_for_section, Section
+
+
+def get_or_create_document_record(
+    client: Client,
+    slug: str,
+    title: str,
+    subtitle: str | None,
+    series: str | None,
+    doc_type: str,
+    version: int,
+    language: str,
+) -> str:
+    """
+    Ищем документ по (slug, version).
+    Если найден — возвращаем id.
+    Если нет — создаём новый.
+    """
+    logger.info(f"Looking for existing document (slug={slug}, version={version})...")
+    existing = (
+        client.table("documents")
+        .select("id")
+        .eq("slug", slug)
+        .eq("version", version)
+        .limit(1)
+        .execute()
+    )
+
+    if existing.data:
+        document_id = existing.data[0]["id"]
+        logger.info(f"Found existing document with id={document_id}")
+        return document_id
+
+    logger.info("Existing document not found. Creating new one...")
+    doc_data = {
+        "slug": slug,
+        "title": title,
+        "subtitle": subtitle,
+        "series": series,
+        "doc_type": doc_type,
+        "version": version,
+        "language": language,
+        # явно, а не через default колонки: не зависим от порядка миграций
+        "status": "active",
+    }
+    resp = client.table("documents").insert(doc_data).execute()
+    logger.info(f"Insert document response: {resp}")
+    if not resp.data:
+        raise RuntimeError("No data returned after inserting document")
+    document_id = resp.data[0]["id"]
+    logger.info(f"Created new document with id={document_id}")
+    return document_id
+
+
+# Есть ли в БД RPC delete_document_content: None — ещё не проверяли,
+# False — функции нет, удаляем двумя обычными DELETE
+_delete_document_content_available: Optional[bool] = None
+
+
+def cleanup_existing_content(client: Client, document_id: str) -> None:
+    """
+    Удаляем старые chunks и sections для этого документа.
+    Основной путь — RPC delete_document_content (sql/delete_document_content.sql):
+    оба DELETE за один запрос и в одной транзакции.
+    Если функции в БД ещё нет — два DELETE по очереди
+    (сначала chunks: они ссылаются на sections). Остальные ошибки RPC
+    пробрасываются.
+    """
+    global _delete_document_content_available
+
+    if _delete_document_content_available is not False:
+        try:
+            resp = client.rpc(
+                "delete_document_content", {"target_document_id": document_id}
+            ).execute()
+            logger.info(f"Cleaned up existing content via delete_document_content: {resp.data}")
+            _delete_document_content_available = True
+            return
+        except APIError as e:
+            if e.code not in MISSING_FUNCTION_ERROR_CODES:
+                raise
+            logger.warning(f"RPC delete_document_content is missing ({e.message}), falling back to plain deletes")
+            _delete_document_content_available = False
+
+    logger.info(f"Cleaning up existing chunks for document_id={document_id}...")
+    resp_chunks = (
+        client.table("chunks").delete().eq("document_id", document_id).execute()
+    )
+    logger.info(f"Chunks delete response: {resp_chunks}")
+
+    logger.info(f"Cleaning up existing sections for document_id={document_id}...")
+    resp_sections = (
+        client.table("sections").delete().eq("document_id", document_id).execute()
+    )
+    logger.info(f"Sections delete response: {resp_sections}")
+
+
+def insert_sections(
+    client: Client,
+    document_id: str,
+    sections: List[Section],
+) -> List[str]:
+    """
+    Вставляет H1-секции в таблицу sections.
+    Возвращает список section_id в том же порядке.
+    """
+
+    # === FIX №1 ===
+    # Если секций нет — НЕ ДЕЛАЕМ INSERT (Supabase падает на insert([]))
+    if not sections:
+        logger.warning(
+            "No sections detected (0 H1 headings). "
+            "Skipping insertion into 'sections' table."
+        )
+        return []
+
+    logger.info(f"Inserting {len(sections)} sections into 'sections' table...")
+
+    payload = []
+    for s in sections:
+        payload.append(
+            {
+                "document_id": document_id,
+                "title": s.title,
+                "level": 1,
+                "order_index": s.index,
+                "full_path": s.title,  # NOT NULL → используем заголовок как путь
+            }
+        )
+
+    resp = client.table("sections").insert(payload).execute()
+    logger.info(f"Insert sections response: {resp}")
+
+    if not resp.data:
+        raise RuntimeError("No data returned after inserting sections")
+
+    section_ids: List[str] = [row["id"] for row in resp.data]
+    return section_ids
+
+
+# Сколько чанков эмбеддится и вставляется за один раз
+CHUNK_BATCH_SIZE = 200
+
+# Сколько батчей эмбеддятся и вставляются одновременно
+# (не больше, чем соединений в пуле httpx-клиента Supabase)
+INSERT_WORKERS = 8
+
+# Один лимит на все потоки процесса (все документы и батчи): не больше
+# INGEST_EMBED_CONCURRENCY запросов к embeddings API одновременно,
+# чтобы не упереться в RPM OpenAI и не потерять embedding у остатка книги
+_embed_semaphore = threading.BoundedSemaphore(settings.INGEST_EMBED_CONCURRENCY)
+
+# Есть ли в БД RPC insert_chunks_bulk: None — ещё не проверяли,
+# False — функции нет, батчи сразу идут обычным insert
+_insert_chunks_bulk_available: Optional[bool] = None
+
+
+def insert_chunks_batch(
+    client: Client,
+    document_id: str,
+    section_ids: List[str],
+    chunk_indexes: List[int],
+    texts: List[str],
+    embeddings: List[Optional[str]],
+) -> None:
+    """
+    Вставляет один батч чанков.
+    Основной путь — RPC insert_chunks_bulk (sql/insert_chunks_bulk.sql):
+    колонки уходят параллельными массивами, Postgres вставляет их
+    одним INSERT ... SELECT FROM unnest(...), без повторения ключей на каждую строку.
+    Если функции в БД ещё нет — обычный insert списком dict'ов
+    (это запоминается, следующие батчи RPC уже не пробуют).
+    Остальные ошибки RPC пробрасываются.
+    """
+    global _insert_chunks_bulk_available
+
+    if _insert_chunks_bulk_available is not False:
+        try:
+            resp = client.rpc(
+                "insert_chunks_bulk",
+                {
+                    "document_id": document_id,
+                    "section_ids": section_ids,
+                    "chunk_indexes": chunk_indexes,
+                    "texts": texts,
+                    "embeddings": embeddings,
+                },
+            ).execute()
+            logger.info(f"Inserted chunks via insert_chunks_bulk: {resp.data}")
+            _insert_chunks_bulk_available = True
+            return
+        except APIError as e:
+            if e.code not in MISSING_FUNCTION_ERROR_CODES:
+                raise
+            logger.warning(f"RPC insert_chunks_bulk is missing ({e.message}), falling back to plain insert")
+            _insert_chunks_bulk_available = False
+
+    # page_from/page_to/tokens_count остаются NULL; quality_flag передаём явно —
+    # без него чанк не попадёт в поиск, если default колонки ещё не задан
+    payload = [
+        {
+            "document_id": document_id,
+            "section_id": section_id,
+            "chunk_index": chunk_index,
+            "text": text,
+            "embedding": embedding,
+            "quality_flag": "ok",
+        }
+        for section_id, chunk_index, text, embedding in zip(
+            section_ids, chunk_indexes, texts, embeddings
+        )
+    ]
+    resp = client.table("chunks").insert(payload).execute()
+    logger.info(f"Insert batch response: {resp}")
+
+
+def embed_and_insert_chunks_batch(
+    client: Client,
+    document_id: str,
+    section_ids: List[str],
+    chunk_indexes: List[int],
+    texts: List[str],
+    embed_failed: threading.Event,
+) -> None:
+    """
+    Считает embedding батча и вставляет батч в chunks.
+    Если OpenAI недоступен — вставляем без embedding (и больше не пытаемся
+    в остальных батчах), его потом досчитает ingest/pipeline/build_embeddings.py
+    """
+    embeddings: List[Optional[str]] = [None] * len(texts)
+    if not embed_failed.is_set():
+        try:
+            with _embed_semaphore:
+                vectors = embed_texts(texts, model=EMBEDDING_MODEL)
+            embeddings = [to_halfvec_literal(emb) for emb in vectors]
+        except OpenAIError as e:
+            logger.warning(f"Embedding at ingest failed, chunks go in without it: {e}")
+            embed_failed.set()
+
+    logger.info(f"Inserting chunks {chunk_indexes[0]}..{chunk_indexes[-1]}")
+    insert_chunks_batch(
+        client,
+        document_id,
+        section_ids,
+        chunk_indexes,
+        texts,
+        embeddings,
+    )
+
+
+def insert_chunks_for_book(
+    client: Client,
+    document_id: str,
+    sections: List[Section],
+    section_ids: List[str],
+) -> None:
+    """
+    Для каждой секции генерирует текстовые чанки и пишет их в таблицу chunks.
+
+    Чанки идут потоком батчами по CHUNK_BATCH_SIZE; батчи эмбеддятся
+    и вставляются параллельно в пуле из INSERT_WORKERS потоков,
+    в памяти одновременно не больше INSERT_WORKERS батчей.
+    """
+    if len(sections) != len(section_ids):
+        raise ValueError("sections and section_ids length mismatch")
+
+    logger.info("Building and inserting chunks for all sections...")
+
+    rows = (
+        (section_id, t)
+        for s, section_id in zip(sections, section_ids)
+        for t in build_text_chunks_for_section(s)
+    )
+
+    inserted = 0
+    embed_failed = threading.Event()
+    pending: Set[Future] = set()
+
+    with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as executor:
+        while batch := list(islice(rows, CHUNK_BATCH_SIZE)):
+            if len(pending) >= INSERT_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            # Колонки батча — параллельными списками (i-й элемент каждого — один чанк)
+            pending.add(
+                executor.submit(
+                    embed_and_insert_chunks_batch,
+                    client,
+                    document_id,
+                    [section_id for section_id, _ in batch],
+                    list(range(inserted + 1, inserted + len(batch) + 1)),
+                    [t for _, t in batch],
+                    embed_failed,
+                )
+            )
+            inserted += len(batch)
+
+        for future in pending:
+            future.result()
+
+    logger.info(f"Inserted {inserted} chunks.")
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
-from typing import List, Dict, Any
+import asyncio
+from typing import List, Dict, Any, Optional
 
+import numpy as np
 from loguru import logger
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from postgrest import APIError, ReturnMethod
+from supabase import Client
 
-from app.core.db import get_supabase_client
+from app.core.db import MISSING_FUNCTION_ERROR_CODES, get_supabase_client
 
 
 # -----------------------------
@@ -15,54 +19,61 @@ from app.core.db import get_supabase_client
 # Размер вектора в БД = 1536 → используем совместимую модель
 EMBEDDING_MODEL = "text-embedding-3-small"
 BATCH_SIZE = 100  # размер батча
+CONCURRENCY = 4  # сколько батчей одновременно отправляем в OpenAI
+
+# Есть ли в БД RPC update_embeddings_bulk: None — ещё не проверяли,
+# False — функции нет, обновляем построчно
+_update_embeddings_bulk_available: Optional[bool] = None
 
 
 # -----------------------------
 # Работа с БД
 # -----------------------------
 
-def fetch_chunks_without_embedding(limit: int = BATCH_SIZE) -> List[Dict[str, Any]]:
+def fetch_chunks_without_embedding(
+    supabase: Client,
+    last_id: Optional[str] = None,
+    limit: int = BATCH_SIZE,
+) -> List[Dict[str, Any]]:
     """
-    Берём чанки, у которых embedding = NULL.
-    ВАЖНО: отбрасываем битые строки без document_id или без текста.
-    Забираем все поля, чтобы при upsert не затирать их в NULL.
+    Берём следующую страницу чанков, у которых embedding = NULL.
+    Keyset-пагинация: id > last_id, сортировка по id — Postgres сразу
+    переходит к нужному месту индекса, а не пересканирует уже обработанное.
+    ВАЖНО: битые строки без document_id или без текста отсекаются
+    фильтром на стороне БД и не передаются по сети.
+    Забираем только id и text — embedding потом обновляется по id.
     """
-    supabase = get_supabase_client()
-    resp = (
+    query = (
         supabase.table("chunks")
-        .select(
-            "id, document_id, section_id, chunk_index, "
-            "page_from, page_to, text, quality_flag, tokens_count"
-        )
+        .select("id, text")
         .is_("embedding", None)
-        .limit(limit)
-        .execute()
+        .not_.is_("document_id", None)
+        .not_.is_("text", None)
+        .neq("text", "")
     )
+    if last_id is not None:
+        query = query.gt("id", last_id)
 
-    raw_rows = resp.data or []
+    resp = query.order("id").limit(limit).execute()
+    rows = resp.data or []
 
-    # фильтрация битых строк
-    rows = [
-        r
-        for r in raw_rows
-        if r.get("document_id") is not None and r.get("text") not in (None, "")
-    ]
-
-    logger.info(
-        "Fetched %d chunks without embedding (filtered from %d raw)",
-        len(rows),
-        len(raw_rows),
-    )
+    logger.info("Fetched {} chunks without embedding", len(rows))
     return rows
 
 
-def update_embeddings(rows: List[Dict[str, Any]], embeddings: List[List[float]]) -> None:
+def update_embeddings(
+    supabase: Client,
+    rows: List[Dict[str, Any]],
+    embeddings: List[str],
+) -> None:
     """
-    Обновляем embedding через upsert.
-    В payload передаём:
-    - id (для однозначной идентификации строки),
-    - document_id и остальные колонки, чтобы избежать вставки
-      новой строки с NULL'ами, и чтобы не ломать NOT NULL.
+    Обновляем только колонку embedding у уже существующих строк.
+    В payload — только id + embedding: остальные колонки строка уже имеет,
+    гонять их по сети и разрешать конфликт upsert'а незачем.
+    Основной путь — одна RPC update_embeddings_bulk (sql/update_embeddings_bulk.sql),
+    если функции в БД ещё нет — точечные UPDATE ... WHERE id = ... по строке
+    (это запоминается; остальные ошибки RPC пробрасываются).
+    embeddings — уже готовые halfvec-литералы (см. to_halfvec_literal).
     """
     if not rows:
         return
@@ -72,110 +83,164 @@ def update_embeddings(rows: List[Dict[str, Any]], embeddings: List[List[float]])
             f"Rows count ({len(rows)}) != embeddings count ({len(embeddings)})"
         )
 
-    supabase = get_supabase_client()
-
-    payload: List[Dict[str, Any]] = []
+    items: List[Dict[str, Any]] = []
     for row, emb in zip(rows, embeddings):
         row_id = row.get("id")
         if not row_id:
-            logger.error("Chunk without id in rows: %s", row)
+            logger.error("Chunk without id in rows: {}", row)
             continue
+        items.append({"id": row_id, "embedding": emb})
 
-        payload.append(
-            {
-                # ключи / идентификаторы
-                "id": row_id,
-                "document_id": row.get("document_id"),
-                "section_id": row.get("section_id"),
-                "chunk_index": row.get("chunk_index"),
-
-                # вспомогательные поля
-                "page_from": row.get("page_from"),
-                "page_to": row.get("page_to"),
-                "text": row.get("text"),
-                "quality_flag": row.get("quality_flag", "ok"),
-                "tokens_count": row.get("tokens_count"),
-
-                # новое поле embedding
-                "embedding": emb,
-            }
-        )
-
-    if not payload:
+    if not items:
         return
 
-    logger.info("Upserting %d chunk embeddings into 'chunks' table", len(payload))
-    resp = supabase.table("chunks").upsert(payload).execute()
-    logger.info("Upsert response: %s", resp.data)
+    logger.info("Updating {} chunk embeddings in 'chunks' table", len(items))
+    global _update_embeddings_bulk_available
+
+    if _update_embeddings_bulk_available is not False:
+        try:
+            resp = supabase.rpc("update_embeddings_bulk", {"items": items}).execute()
+            logger.info("Updated rows: {}", resp.data)
+            _update_embeddings_bulk_available = True
+            return
+        except APIError as e:
+            if e.code not in MISSING_FUNCTION_ERROR_CODES:
+                raise
+            logger.warning(
+                "RPC update_embeddings_bulk is missing ({}), falling back to per-row update",
+                e.message,
+            )
+            _update_embeddings_bulk_available = False
+
+    for item in items:
+        (
+            supabase.table("chunks")
+            .update({"embedding": item["embedding"]}, returning=ReturnMethod.minimal)
+            .eq("id", item["id"])
+            .execute()
+        )
 
 
 # -----------------------------
 # Embeddings через OpenAI
 # -----------------------------
 
-def build_embeddings_for_batch(client: OpenAI, rows: List[Dict[str, Any]]) -> None:
+def to_halfvec_literal(embedding: List[float]) -> str:
+    """
+    Нормируем embedding до единичной длины, округляем до float16
+    и собираем текстовый литерал halfvec "[...]".
+    Колонка chunks.embedding — halfvec(1536) (sql/halfvec_embeddings.sql):
+    в БД вдвое меньше байт на вектор, а по сети идёт ~5 значащих цифр
+    вместо 17 у float64 из JSON OpenAI.
+    В БД лежат единичные векторы, поэтому при поиске косинус —
+    просто скалярное произведение (OpenAI отдаёт почти единичные векторы,
+    нормируем на всякий случай).
+    """
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    if norm:
+        vec = vec / norm
+    half = vec.astype(np.float16)
+    return "[" + ",".join(map(str, half)) + "]"
+
+
+async def build_embeddings_for_batch(
+    client: AsyncOpenAI,
+    supabase: Client,
+    semaphore: asyncio.Semaphore,
+    rows: List[Dict[str, Any]],
+) -> None:
     """
     Один батч:
-    1) вытаскиваем тексты;
-    2) считаем embedding;
-    3) пишем в БД.
+    1) вытаскиваем тексты, дубликаты схлопываем;
+    2) считаем embedding (не больше CONCURRENCY запросов к OpenAI одновременно);
+    3) пишем в БД (в отдельном потоке, клиент Supabase синхронный).
     """
     if not rows:
         logger.info("No rows in batch, nothing to embed")
         return
 
-    texts = [row["text"] or "" for row in rows]
+    # Одинаковые тексты (повторяющиеся заголовки, шаблонные абзацы) отправляем
+    # в OpenAI один раз, а embedding раздаём всем строкам с этим текстом
+    unique_index: Dict[str, int] = {}
+    row_to_unique: List[int] = []
+    for row in rows:
+        text = row["text"] or ""
+        row_to_unique.append(unique_index.setdefault(text, len(unique_index)))
+    unique_texts = list(unique_index)
 
     logger.info(
-        "Requesting embeddings for %d texts (model=%s)",
-        len(texts),
+        "Requesting embeddings for {} unique texts of {} (model={})",
+        len(unique_texts),
+        len(rows),
         EMBEDDING_MODEL,
     )
 
-    response = client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=texts,
-    )
+    async with semaphore:
+        response = await client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=unique_texts,
+        )
 
-    embeddings: List[List[float]] = [item.embedding for item in response.data]
-    update_embeddings(rows, embeddings)
+    unique_embeddings = [to_halfvec_literal(item.embedding) for item in response.data]
+    embeddings = [unique_embeddings[i] for i in row_to_unique]
+    await asyncio.to_thread(update_embeddings, supabase, rows, embeddings)
 
 
 # -----------------------------
 # Основной цикл пайплайна
 # -----------------------------
 
-def build_embeddings_for_all_chunks() -> None:
+async def build_embeddings_for_all_chunks_async() -> None:
     """
     Цикл до полного обнуления очереди:
-    - берём батч чанков без embedding;
-    - считаем embedding;
-    - пишем в БД;
+    - берём до CONCURRENCY батчей чанков без embedding;
+    - считаем embedding для батчей параллельно и пишем в БД;
     - повторяем, пока нечего обрабатывать.
+
+    Оба клиента создаются один раз на весь прогон: все итерации идут
+    по одним и тем же keep-alive соединениям без повторных TLS-рукопожатий,
+    а параллельные батчи к OpenAI мультиплексируются в одном HTTP/2-соединении.
     """
-    client = OpenAI()
+    supabase = get_supabase_client()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
 
     total_processed = 0
     iteration = 0
+    last_id: Optional[str] = None
+
+    # async with закрывает соединения и при ошибке посреди прогона
+    async with AsyncOpenAI(http_client=DefaultAsyncHttpxClient(http2=True)) as client:
+        while True:
+            iteration += 1
+            logger.info("Iteration {}: fetching next {} batches...", iteration, CONCURRENCY)
+            rows = await asyncio.to_thread(
+                fetch_chunks_without_embedding, supabase, last_id, BATCH_SIZE * CONCURRENCY
+            )
+
+            if not rows:
+                logger.info("No more *valid* chunks without embeddings. Finished.")
+                break
+
+            last_id = rows[-1]["id"]
+
+            batches = [rows[i : i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+            await asyncio.gather(
+                *(build_embeddings_for_batch(client, supabase, semaphore, batch) for batch in batches)
+            )
+
+            total_processed += len(rows)
+            logger.info(
+                "Iteration {} done. Rows={}, batches={}, total processed={}",
+                iteration,
+                len(rows),
+                len(batches),
+                total_processed,
+            )
 
-    while True:
-        iteration += 1
-        logger.info("Iteration %d: fetching next batch...", iteration)
-        rows = fetch_chunks_without_embedding(limit=BATCH_SIZE)
-
-        if not rows:
-            logger.info("No more *valid* chunks without embeddings. Finished.")
-            break
-
-        build_embeddings_for_batch(client, rows)
-        batch_count = len(rows)
-        total_processed += batch_count
-        logger.info(
-            "Iteration %d done. Batch size=%d, total processed=%d",
-            iteration,
-            batch_count,
-            total_processed,
-        )
+
+def build_embeddings_for_all_chunks() -> None:
+    asyncio.run(build_embeddings_for_all_chunks_async())
 
 
 # -----------------------------
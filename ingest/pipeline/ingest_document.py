@@ -33,15 +33,11 @@ def insert_test_document(client: Client) -> None:
     logger.info(f"Created document with id={document_id}")
 
     # 2. Создаём один тестовый chunk
+    # (остальные колонки — NULL)
     chunk_data = {
         "document_id": document_id,
-        "section_id": None,
         "chunk_index": 1,
-        "page_from": None,
-        "page_to": None,
         "text": "Это тестовый фрагмент текста, записанный в таблицу chunks для проверки пайплайна.",
-        "embedding": None,
-        "tokens_count": None,
         "quality_flag": "ok",
     }
 
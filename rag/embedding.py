@@ -1,15 +1,81 @@
-import os
+from functools import lru_cache
+from typing import Iterator
+import unicodedata
+
 from openai import OpenAI
 
-client = OpenAI(api_key=os.getenv("EMBEDDINGS_API_KEY"))
+from app.core.config import settings
+
+# Ограничения одного запроса к embeddings API: до 2048 входов
+# и до 300k токенов суммарно — берём с запасом
+MAX_BATCH_INPUTS = 512
+MAX_BATCH_TOKENS = 200_000
+
+
+@lru_cache(maxsize=1)
+def get_client() -> OpenAI:
+    """
+    Клиент OpenAI для embeddings, один на процесс.
+    Создаётся при первом вызове, а не при импорте: модуль можно импортировать
+    без ключа (ingest тогда вставит чанки без embedding).
+    Без ключа конструктор бросает OpenAIError — кэш её не запоминает.
+    """
+    return OpenAI(api_key=settings.EMBEDDINGS_API_KEY)
+
 
 def embed_text(text: str) -> list[float]:
     """
     Делает embedding через OpenAI.
     Возвращает массив чисел (vector).
+    Одинаковые тексты повторно не отправляются — берутся из LRU-кэша.
     """
-    resp = client.embeddings.create(
+    return list(_embed_text_cached(unicodedata.normalize("NFC", text.strip())))
+
+
+@lru_cache(maxsize=1024)
+def _embed_text_cached(text: str) -> tuple[float, ...]:
+    resp = get_client().embeddings.create(
         model="text-embedding-3-large",
         input=text
     )
-    return resp.data[0].embedding
\ No newline at end of file
+    return tuple(resp.data[0].embedding)
+
+
+def _estimate_tokens(text: str) -> int:
+    # Грубая верхняя оценка без токенизатора: для русского текста
+    # в cl100k выходит примерно 2-3 символа на токен
+    return len(text) // 2 + 1
+
+
+def _iter_batches(texts: list[str]) -> Iterator[tuple[int, list[str]]]:
+    """
+    Режет тексты на батчи по MAX_BATCH_INPUTS / MAX_BATCH_TOKENS.
+    Отдаёт (индекс первого текста батча, тексты батча).
+    """
+    start = 0
+    batch: list[str] = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = _estimate_tokens(text)
+        if batch and (len(batch) >= MAX_BATCH_INPUTS or batch_tokens + tokens > MAX_BATCH_TOKENS):
+            yield start, batch
+            start, batch, batch_tokens = i, [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield start, batch
+
+
+def embed_texts(texts: list[str], model: str = "text-embedding-3-large") -> list[list[float]]:
+    """
+    Embedding для списка текстов: батчами по несколько сотен текстов на запрос
+    (вместо запроса на каждый текст) через общий клиент модуля.
+    Возвращает векторы в том же порядке, что и texts.
+    """
+    result: list[list[float]] = [[] for _ in texts]
+    client = get_client()
+    for start, batch in _iter_batches(texts):
+        resp = client.embeddings.create(model=model, input=batch)
+        for item in resp.data:
+            result[start + item.index] = item.embedding
+    return result
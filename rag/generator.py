@@ -1,8 +1,9 @@
-import os
 from openai import OpenAI
 
+from app.core.config import settings
+
 # Используем отдельный ключ для LLM (может совпадать с OPENAI_API_KEY)
-LLM_API_KEY = os.getenv("LLM_API_KEY") or os.getenv("OPENAI_API_KEY")
+LLM_API_KEY = settings.LLM_API_KEY
 
 if not LLM_API_KEY:
     raise RuntimeError("LLM_API_KEY / OPENAI_API_KEY не задан в переменных окружения")
@@ -1,9 +1,11 @@
 import argparse
+import asyncio
 from typing import Optional, List
 
+from loguru import logger
 from openai import OpenAI
 
-from rag.retrieval import retrieve_top_k, Chunk, get_openai_client
+from rag.retrieval import retrieve_top_k_async, Chunk, get_openai_client
 
 
 SYSTEM_PROMPT = """
@@ -15,9 +17,22 @@ SYSTEM_PROMPT = """
 """
 
 
+# Неизменное начало пользовательского сообщения. Вместе с SYSTEM_PROMPT оно
+# образует общий для всех запросов префикс, который OpenAI кэширует
+# (prompt caching), поэтому всё переменное — контекст и вопрос — идёт после него
+PROMPT_HEADER = """
+Ответь на вопрос, приведённый в конце сообщения, используя только фрагменты контекста ниже.
+""".strip()
+
+# Ключ маршрутизации prompt caching: запросы CLI с общим префиксом
+# попадают на один сервер OpenAI
+PROMPT_CACHE_KEY = "rag-qa-cli"
+
+
 def build_prompt(query: str, chunks: List[Chunk]) -> str:
     """
     Формируем текстовый промпт вида:
+    [HEADER]
     [CONTEXT]
     ===
     [QUESTION]
@@ -29,6 +44,8 @@ def build_prompt(query: str, chunks: List[Chunk]) -> str:
     context_text = "\n\n".join(context_parts)
 
     prompt = f"""
+{PROMPT_HEADER}
+
 Контекст:
 {context_text}
 
@@ -41,14 +58,14 @@ def build_prompt(query: str, chunks: List[Chunk]) -> str:
     return prompt
 
 
-def ask_rag(query: str, slug: Optional[str], k: int = 5, preload_limit: Optional[int] = None) -> str:
+async def ask_rag(query: str, slug: Optional[str], k: int = 5) -> str:
     """
     Полный цикл:
     - поиск релевантных чанков
     - генерация ответа модели
     """
     # 1. Поиск чанков
-    scored = retrieve_top_k(query=query, slug=slug, k=k, preload_limit=preload_limit)
+    scored = await retrieve_top_k_async(query=query, slug=slug, k=k)
     chunks = [ch for ch, _sim in scored]
 
     if not chunks:
@@ -59,13 +76,15 @@ def ask_rag(query: str, slug: Optional[str], k: int = 5, preload_limit: Optional
 
     # 3. Вызов модели
     client: OpenAI = get_openai_client()
-    resp = client.chat.completions.create(
+    resp = await asyncio.to_thread(
+        client.chat.completions.create,
         model="gpt-4.1-mini",
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
         temperature=0.1,
+        prompt_cache_key=PROMPT_CACHE_KEY,
     )
 
     return resp.choices[0].message.content.strip()
@@ -91,17 +110,21 @@ def main():
         "--preload-limit",
         type=int,
         default=None,
-        help="Опционально: ограничить количество загружаемых чанков "
-             "для ускорения (по умолчанию все).",
+        help="Устарел и игнорируется: поиск всегда идёт по всему корпусу. "
+             "Оставлен для совместимости, как preload_limit в web-API.",
     )
 
     args = parser.parse_args()
 
-    answer = ask_rag(
-        query=args.query,
-        slug=args.slug,
-        k=args.top_k,
-        preload_limit=args.preload_limit,
+    if args.preload_limit is not None:
+        logger.warning("--preload-limit is deprecated and ignored: retrieval always covers the whole corpus")
+
+    answer = asyncio.run(
+        ask_rag(
+            query=args.query,
+            slug=args.slug,
+            k=args.top_k,
+        )
     )
     print("\n=== ОТВЕТ ===\n")
     print(answer)
@@ -1,25 +1,52 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
-from typing import Any, List, Optional, Tuple
-import json
+from functools import lru_cache
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import unicodedata
 
+import httpx
 import numpy as np
+import orjson
 from loguru import logger
-from openai import OpenAI
+from openai import DefaultHttpxClient, OpenAI
+from postgrest import APIError
 
-from app.core.db import get_supabase_client
+from app.core.db import MISSING_FUNCTION_ERROR_CODES, get_supabase_client
 
 # ДОЛЖНО совпадать с моделью, используемой в ingest/pipeline/build_embeddings.py
 EMBEDDING_MODEL = "text-embedding-3-small"
 
+# Есть ли в БД RPC match_chunks: None — ещё не проверяли,
+# False — функции нет, поиск идёт по резидентному индексу чанков (ChunkIndex)
+_match_chunks_available: Optional[bool] = None
 
+
+class RetrievalUnavailableError(RuntimeError):
+    """
+    Поиск сейчас невозможен: RPC match_chunks упала с временной ошибкой,
+    а тёплого резидентного индекса для подмены нет. Web-API отвечает 503.
+    """
+
+
+@lru_cache(maxsize=1)
 def get_openai_client() -> OpenAI:
     """
     Унифицированная точка получения клиента OpenAI.
     qa_cli импортирует именно эту функцию.
+
+    Клиент один на процесс: embeddings и chat-запросы идут по общему пулу
+    keep-alive соединений (HTTP/2), без нового TLS-рукопожатия на каждый вызов.
     """
-    return OpenAI()
+    return OpenAI(
+        http_client=DefaultHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    )
 
 
 @dataclass
@@ -35,16 +62,24 @@ class Chunk:
     #  - строка с JSON-массивом
     embedding: Optional[Any]
     quality_flag: str
+    # Мета документа (подтягивается тем же запросом через documents(...))
+    book_title: Optional[str] = None
+    book_series: Optional[str] = None
 
 
 def _get_supabase():
     return get_supabase_client()
 
 
+# PostgREST в Supabase по умолчанию отдаёт не больше 1000 строк за запрос,
+# поэтому чанки читаются страницами с курсором по id
+CHUNK_PAGE_SIZE = 1000
+
+
 def load_chunks(
     slug: Optional[str] = None,
     slugs: Optional[List[str]] = None,
-    limit: int = 2000,
+    limit: Optional[int] = 2000,
 ) -> List[Chunk]:
     """
     Загружает чанки из Supabase.
@@ -57,68 +92,69 @@ def load_chunks(
     Во всех случаях:
       – embedding IS NOT NULL,
       – quality_flag == 'ok',
-      – ограничение по limit.
+      – ограничение по limit (None или 0 — без ограничения, весь корпус).
     """
     supabase = _get_supabase()
 
-    # Базовый запрос по чанкам
-    query = (
-        supabase.table("chunks")
-        .select("id, document_id, text, embedding, quality_flag")
-    )
-
     # Если указан slug или список slugs — сначала находим document_id по таблице documents
     doc_ids: List[str] = []
 
-    if slugs:
-        logger.info("Loading document_ids for slugs=%s", slugs)
+    match_slugs = slugs or ([slug] if slug else None)
+    if match_slugs:
+        logger.info("Loading document_ids for slugs={}", match_slugs)
         doc_resp = (
             supabase.table("documents")
-            .select("id, slug")
-            .in_("slug", slugs)
+            .select("id")
+            .in_("slug", match_slugs)
             .execute()
         )
-        doc_rows = doc_resp.data or []
-        doc_ids = [row["id"] for row in doc_rows if "id" in row]
+        doc_ids = [row["id"] for row in doc_resp.data or [] if "id" in row]
 
         if not doc_ids:
-            logger.warning("No documents found for slugs=%s", slugs)
+            logger.warning("No documents found for slug={}, slugs={}", slug, slugs)
             return []
 
-    elif slug:
-        logger.info("Loading document_ids for slug=%s", slug)
-        doc_resp = (
-            supabase.table("documents")
-            .select("id")
-            .eq("slug", slug)
-            .execute()
+    rows: List[Dict[str, Any]] = []
+    last_id: Optional[str] = None
+
+    while True:
+        page_size = CHUNK_PAGE_SIZE
+        if limit is not None and limit > 0:
+            page_size = min(page_size, limit - len(rows))
+            if page_size <= 0:
+                break
+
+        # Базовый запрос по чанкам; title/series документа берём тем же запросом
+        # (встраивание связанной таблицы PostgREST по FK chunks.document_id).
+        # Билдер postgrest изменяемый, поэтому на каждую страницу — новый запрос.
+        query = (
+            supabase.table("chunks")
+            .select("id, document_id, text, embedding, quality_flag, documents(title, series)")
         )
-        doc_rows = doc_resp.data or []
-        doc_ids = [row["id"] for row in doc_rows if "id" in row]
 
-        if not doc_ids:
-            logger.warning("No documents found for slug=%s", slug)
-            return []
+        # Если мы нашли какие-то document_id — фильтруем по ним чанки
+        if doc_ids:
+            query = query.in_("document_id", doc_ids)
 
-    # Если мы нашли какие-то document_id — фильтруем по ним чанки
-    if doc_ids:
-        query = query.in_("document_id", doc_ids)
+        # Фильтрация: embedding IS NOT NULL и нормальный quality_flag
+        query = (
+            query
+            .not_.is_("embedding", None)  # embedding IS NOT NULL
+            .eq("quality_flag", "ok")
+        )
 
-    # Фильтрация: embedding IS NOT NULL и нормальный quality_flag
-    query = (
-        query
-        .not_.is_("embedding", None)  # embedding IS NOT NULL
-        .eq("quality_flag", "ok")
-    )
+        if last_id is not None:
+            query = query.gt("id", last_id)
 
-    if limit is not None and limit > 0:
-        query = query.limit(limit)
+        page = query.order("id").limit(page_size).execute().data or []
+        rows.extend(page)
 
-    resp = query.execute()
-    rows = resp.data or []
+        if len(page) < page_size:
+            break
+        last_id = page[-1]["id"]
 
     logger.info(
-        "Loaded %d chunks (slug=%s, slugs=%s, limit=%s)",
+        "Loaded {} chunks (slug={}, slugs={}, limit={})",
         len(rows),
         slug,
         slugs,
@@ -127,6 +163,7 @@ def load_chunks(
 
     chunks: List[Chunk] = []
     for row in rows:
+        doc = row.get("documents") or {}
         chunks.append(
             Chunk(
                 id=row["id"],
@@ -134,103 +171,336 @@ def load_chunks(
                 text=row["text"],
                 embedding=row.get("embedding"),
                 quality_flag=row.get("quality_flag", "ok"),
+                book_title=doc.get("title"),
+                book_series=doc.get("series"),
             )
         )
 
     return chunks
 
 
+# Сколько последних запросов держим в кэше эмбеддингов (~6 КБ на вектор float32)
+EMBED_CACHE_SIZE = 1024
+
+
 def embed_query(text: str) -> List[float]:
     """
     Строит эмбеддинг для текстового запроса через OpenAI.
+
+    Повторные запросы (тот же текст с точностью до пробелов по краям
+    и Unicode-нормализации) берутся из in-memory LRU-кэша без похода в сеть.
     """
+    key = unicodedata.normalize("NFC", text.strip())
+    return list(_embed_query_cached(key))
+
+
+@lru_cache(maxsize=EMBED_CACHE_SIZE)
+def _embed_query_cached(text: str) -> Tuple[float, ...]:
     client = get_openai_client()
-    logger.info("Requesting embedding for query (len=%d chars)", len(text))
+    logger.info("Requesting embedding for query (len={} chars)", len(text))
     resp = client.embeddings.create(
         model=EMBEDDING_MODEL,
         input=[text],
     )
-    return resp.data[0].embedding
-
-
-def _cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    """
-    Косинусное сходство двух векторов.
-    """
-    denom = float(np.linalg.norm(a) * np.linalg.norm(b))
-    if denom == 0.0:
-        return 0.0
-    return float(np.dot(a, b) / denom)
+    # кортеж — чтобы закэшированное значение нельзя было случайно изменить
+    return tuple(resp.data[0].embedding)
 
 
-def _normalize_embedding(emb_raw: Any) -> Optional[List[float]]:
+def _normalize_embedding(emb_raw: Any) -> Optional[np.ndarray]:
     """
-    Приводим embedding к List[float].
+    Приводим embedding к одномерному np.ndarray float32.
 
     Возможные варианты:
-      - уже list[float] → возвращаем как есть;
-      - строка с JSON-массивом → json.loads(...);
-      - всё остальное → None.
+      - строка с JSON-массивом (так PostgREST отдаёт vector/halfvec) → orjson.loads(...);
+      - list/tuple чисел;
+      - всё остальное (или пустой вектор) → None.
     """
     if emb_raw is None:
         return None
 
-    # У Supabase часто vector хранится как строка с JSON
+    # У Supabase vector/halfvec приходит строкой "[...]"
     if isinstance(emb_raw, str):
         try:
-            parsed = json.loads(emb_raw)
-        except json.JSONDecodeError:
+            emb_raw = orjson.loads(emb_raw)
+        except orjson.JSONDecodeError:
             logger.warning("Failed to JSON-decode embedding string, skipping chunk")
             return None
-        if not isinstance(parsed, list):
+        if not isinstance(emb_raw, list):
             return None
-        return parsed
 
-    if isinstance(emb_raw, (list, tuple)):
-        return list(emb_raw)
+    if not isinstance(emb_raw, (list, tuple)):
+        # Неподдерживаемый формат
+        logger.warning("Unsupported embedding type {}, skipping chunk", type(emb_raw))
+        return None
 
-    # Неподдерживаемый формат
-    logger.warning("Unsupported embedding type %s, skipping chunk", type(emb_raw))
-    return None
+    try:
+        vec = np.asarray(emb_raw, dtype=np.float32)
+    except (TypeError, ValueError):
+        logger.warning("Failed to convert embedding to np.array, skipping chunk")
+        return None
 
+    if vec.ndim != 1 or vec.size == 0:
+        return None
+    return vec
 
-def score_chunks_by_similarity(
-    query_embedding: List[float],
-    chunks: List[Chunk],
-) -> List[Tuple[Chunk, float]]:
+
+def _top_k_indices(sims: np.ndarray, k: Optional[int] = None) -> np.ndarray:
     """
-    Считает косинусное сходство между эмбеддингом запроса и эмбеддингами чанков.
+    Индексы k наибольших значений sims по убыванию.
 
-    ВАЖНО: возвращает список (Chunk, score), а не только Chunk —
-    это соответствует ожиданиям qa_cli:
-        scored = retrieve_top_k(...)
-        chunks = [ch for ch, _sim in scored]
+    np.argpartition выбирает top-k за O(N), сортируются только k элементов;
+    без k — полная сортировка (при равенстве — в исходном порядке).
     """
-    q_vec = np.array(query_embedding, dtype=np.float32)
+    if k is None or k >= sims.size:
+        return np.argsort(-sims, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
 
-    scored: List[Tuple[Chunk, float]] = []
+    top = np.argpartition(-sims, k - 1)[:k]
+    return top[np.argsort(-sims[top], kind="stable")]
 
-    for ch in chunks:
-        emb_list = _normalize_embedding(ch.embedding)
-        if not emb_list:
-            # нет валидного эмбеддинга — пропускаем
-            continue
 
-        try:
-            c_vec = np.array(emb_list, dtype=np.float32)
-        except (TypeError, ValueError):
-            logger.warning("Failed to convert embedding to np.array, skipping chunk")
-            continue
+# Сколько секунд держим резидентный индекс чанков, прежде чем перечитать корпус
+CHUNK_INDEX_TTL_SECONDS = 600
+
+
+@dataclass
+class ChunkIndex:
+    """
+    Резидентный индекс всех чанков корпуса для скоринга на клиенте.
+
+    Корпус между ingest-ами не меняется, поэтому чанки загружаются один раз
+    (и заново — по истечении TTL или после invalidate_chunk_index),
+    а не на каждый запрос:
+      - matrix — эмбеддинги (N, D) float32 с нормированными строками
+        (при ingest они уже единичные, здесь — на случай старых записей);
+      - chunks — метаданные в том же порядке (без эмбеддингов);
+      - slug_masks — заранее посчитанная булева маска строк для каждого slug.
+    """
+    matrix: np.ndarray
+    chunks: List[Chunk]
+    slug_masks: Dict[str, np.ndarray]
+    loaded_at: float
+
+    @classmethod
+    def build(cls) -> "ChunkIndex":
+        chunks = load_chunks(limit=None)
+
+        valid: List[Chunk] = []
+        vectors: List[np.ndarray] = []
+        dim: Optional[int] = None
+
+        for ch in chunks:
+            vec = _normalize_embedding(ch.embedding)
+            if vec is None:
+                continue
+
+            if dim is None:
+                dim = vec.shape[0]
+            elif vec.shape[0] != dim:
+                logger.warning(
+                    "Embedding dim {} != index dim {}, skipping chunk", vec.shape[0], dim
+                )
+                continue
+
+            # вектор дальше живёт только в матрице
+            ch.embedding = None
+            vectors.append(vec)
+            valid.append(ch)
+
+        if vectors:
+            matrix = np.vstack(vectors)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            np.divide(matrix, norms, out=matrix, where=norms != 0)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        doc_rows = _get_supabase().table("documents").select("id, slug").execute().data or []
+        doc_ids_by_slug: Dict[str, List[str]] = {}
+        for row in doc_rows:
+            doc_ids_by_slug.setdefault(row["slug"], []).append(row["id"])
+
+        chunk_doc_ids = np.asarray([ch.document_id for ch in valid])
+        slug_masks = {
+            slug: np.isin(chunk_doc_ids, ids)
+            for slug, ids in doc_ids_by_slug.items()
+        }
+
+        logger.info(
+            "Built chunk index: {} chunks, {} slugs, {:.1f} MB",
+            len(valid),
+            len(slug_masks),
+            matrix.nbytes / 2**20,
+        )
+        return cls(matrix=matrix, chunks=valid, slug_masks=slug_masks, loaded_at=time.time())
+
+    def search(
+        self,
+        query_embedding: List[float],
+        slug: Optional[str] = None,
+        slugs: Optional[List[str]] = None,
+        k: int = 5,
+    ) -> List[Tuple[Chunk, float]]:
+        """
+        Top-k по косинусному сходству: строки матрицы уже нормированы,
+        так что достаточно нормировать запрос и умножить матрицу на вектор.
+        """
+        q_vec = np.asarray(query_embedding, dtype=np.float32)
+        if self.matrix.shape[0] == 0:
+            return []
+        if q_vec.shape[0] != self.matrix.shape[1]:
+            logger.warning(
+                "Query dim {} != index dim {}", q_vec.shape[0], self.matrix.shape[1]
+            )
+            return []
+
+        q_norm = np.linalg.norm(q_vec)
+        if q_norm != 0:
+            q_vec = q_vec / q_norm
 
-        sim = _cosine_similarity(q_vec, c_vec)
-        scored.append((ch, sim))
+        match_slugs = slugs or ([slug] if slug else None)
+        if match_slugs:
+            mask = np.zeros(len(self.chunks), dtype=bool)
+            for s in match_slugs:
+                slug_mask = self.slug_masks.get(s)
+                if slug_mask is not None:
+                    mask |= slug_mask
+            rows = np.flatnonzero(mask)
+            if rows.size == 0:
+                logger.warning("No chunks found for slug={}, slugs={}", slug, slugs)
+                return []
+            sims = self.matrix[rows] @ q_vec
+        else:
+            rows = np.arange(len(self.chunks))
+            sims = self.matrix @ q_vec
 
-    # сортируем по score по убыванию
-    scored_sorted = sorted(scored, key=lambda pair: pair[1], reverse=True)
-    return scored_sorted
+        top = _top_k_indices(sims, k)
+        return [(self.chunks[rows[i]], float(sims[i])) for i in top]
 
 
-def retrieve_top_k(
+_chunk_index: Optional[ChunkIndex] = None
+_chunk_index_lock = threading.Lock()
+
+
+def get_chunk_index() -> ChunkIndex:
+    """
+    Возвращает резидентный индекс чанков, при необходимости (первый вызов,
+    истёк TTL) строит его заново. Параллельные запросы ждут одну сборку.
+    """
+    global _chunk_index
+
+    with _chunk_index_lock:
+        if (
+            _chunk_index is None
+            or time.time() - _chunk_index.loaded_at >= CHUNK_INDEX_TTL_SECONDS
+        ):
+            _chunk_index = ChunkIndex.build()
+        return _chunk_index
+
+
+def _chunk_index_is_warm() -> bool:
+    """
+    Есть ли готовый индекс чанков, который не придётся перестраивать.
+    """
+    index = _chunk_index
+    return index is not None and time.time() - index.loaded_at < CHUNK_INDEX_TTL_SECONDS
+
+
+def invalidate_chunk_index() -> None:
+    """
+    Сбрасывает резидентный индекс чанков (например, после завершения ingest).
+    """
+    global _chunk_index
+
+    with _chunk_index_lock:
+        _chunk_index = None
+
+
+def _fallback_after_rpc_error(error: Exception) -> None:
+    """
+    Временная ошибка RPC match_chunks (таймаут, обрыв соединения, statement
+    timeout и т.п.): следующий запрос снова пойдёт в RPC. Считаем на клиенте,
+    только если индекс уже в памяти — собирать весь корпус, пока БД
+    перегружена, нельзя.
+    """
+    if _chunk_index_is_warm():
+        logger.warning("RPC match_chunks failed ({}), falling back to client-side scoring", error)
+        return None
+    logger.error("RPC match_chunks failed ({}), no warm chunk index to fall back to", error)
+    raise RetrievalUnavailableError("match_chunks RPC failed") from error
+
+
+def match_chunks(
+    query_embedding: List[float],
+    slug: Optional[str] = None,
+    slugs: Optional[List[str]] = None,
+    k: int = 5,
+) -> Optional[List[Tuple[Chunk, float]]]:
+    """
+    Top-k на стороне Postgres: RPC match_chunks (sql/match_chunks.sql),
+    ORDER BY embedding <=> query LIMIT k по HNSW-индексу.
+    По сети приходят только k строк без эмбеддингов и quality_flag
+    (RPC отбирает только чанки с quality_flag = 'ok').
+
+    Возвращает None, если функции match_chunks нет в БД (RPC отключается
+    до перезапуска) или вызов упал, но резидентный индекс уже в памяти, —
+    тогда вызывающий код считает сходство на клиенте.
+    При временной ошибке без тёплого индекса бросает RetrievalUnavailableError.
+    """
+    global _match_chunks_available
+
+    match_slugs = slugs or ([slug] if slug else None)
+
+    try:
+        resp = (
+            _get_supabase()
+            .rpc(
+                "match_chunks",
+                {
+                    "query_embedding": query_embedding,
+                    "match_slugs": match_slugs,
+                    "match_count": k,
+                },
+            )
+            .execute()
+        )
+    except APIError as e:
+        if e.code in MISSING_FUNCTION_ERROR_CODES:
+            logger.warning("RPC match_chunks is missing ({}), switching to client-side scoring", e.message)
+            _match_chunks_available = False
+            return None
+        return _fallback_after_rpc_error(e)
+    except httpx.HTTPError as e:
+        return _fallback_after_rpc_error(e)
+
+    _match_chunks_available = True
+
+    rows = resp.data or []
+    if match_slugs and len(rows) < k:
+        # с фильтром по slug RPC перебирает чанки точно и недобор возможен,
+        # только если в выбранных книгах меньше k чанков
+        logger.warning(
+            "RPC match_chunks returned {} < {} rows for slugs={}", len(rows), k, match_slugs
+        )
+
+    return [
+        (
+            Chunk(
+                id=row["id"],
+                document_id=row["document_id"],
+                text=row["text"],
+                embedding=None,
+                quality_flag="ok",
+                book_title=row.get("book_title"),
+                book_series=row.get("book_series"),
+            ),
+            float(row["similarity"]),
+        )
+        for row in rows
+    ]
+
+
+async def retrieve_top_k_async(
     query: str,
     slug: Optional[str] = None,
     slugs: Optional[List[str]] = None,
@@ -240,13 +510,22 @@ def retrieve_top_k(
     """
     Главная функция retrieval-слоя, которую вызывает qa_cli и web-API.
 
-    1) Загружает до preload_limit чанков (по slug, по списку slugs или по всем документам).
-    2) Строит эмбеддинг запроса.
-    3) Считает косинусное сходство с каждым чанком.
+    1) Строит эмбеддинг запроса.
+    2) Ищет top-k в Postgres через RPC match_chunks (pgvector).
+    3) Если RPC недоступна — считает косинусное сходство на клиенте
+       по резидентному индексу всех чанков (ChunkIndex), с фильтром
+       по slug / списку slugs. Если RPC упала с временной ошибкой, а индекс
+       ещё не собран, бросает RetrievalUnavailableError (web-API отвечает 503).
     4) Возвращает top-k (Chunk, score), отсортированные по score (убывание).
+
+    preload_limit оставлен для совместимости API: индекс держит весь корпус.
+
+    Блокирующие HTTP-вызовы (OpenAI, Supabase) идут в потоках и не занимают
+    event loop. Когда уже известно, что RPC нет, получение индекса и эмбеддинг
+    запроса друг от друга не зависят и выполняются параллельно.
     """
     logger.info(
-        "retrieve_top_k(query_len=%d, slug=%s, slugs=%s, k=%d, preload_limit=%d)",
+        "retrieve_top_k(query_len={}, slug={}, slugs={}, k={}, preload_limit={})",
         len(query),
         slug,
         slugs,
@@ -254,14 +533,22 @@ def retrieve_top_k(
         preload_limit,
     )
 
-    chunks = load_chunks(slug=slug, slugs=slugs, limit=preload_limit)
-    if not chunks:
-        logger.warning("No chunks loaded for slug=%s, slugs=%s", slug, slugs)
-        return []
+    if _match_chunks_available is False:
+        index, query_embedding = await asyncio.gather(
+            asyncio.to_thread(get_chunk_index),
+            asyncio.to_thread(embed_query, query),
+        )
+    else:
+        query_embedding = await asyncio.to_thread(embed_query, query)
+
+        matched = await asyncio.to_thread(match_chunks, query_embedding, slug=slug, slugs=slugs, k=k)
+        if matched is not None:
+            logger.info("retrieve_top_k: got {} results from match_chunks", len(matched))
+            return matched
 
-    query_embedding = embed_query(query)
-    scored_chunks = score_chunks_by_similarity(query_embedding, chunks)
+        index = await asyncio.to_thread(get_chunk_index)
 
-    top = scored_chunks[:k]
-    logger.info("retrieve_top_k: got %d results", len(top))
+    top = index.search(query_embedding, slug=slug, slugs=slugs, k=k)
+    logger.info("retrieve_top_k: got {} results", len(top))
     return top
+
@@ -0,0 +1,13 @@
+-- chunks и sections удаляются вместе со своим документом (ON DELETE CASCADE):
+-- для удаления книги достаточно одного DELETE по documents.
+-- Используется tools/cleanup_duplicate_documents.py.
+
+alter table public.chunks
+  drop constraint if exists chunks_document_id_fkey,
+  add constraint chunks_document_id_fkey
+    foreign key (document_id) references public.documents (id) on delete cascade;
+
+alter table public.sections
+  drop constraint if exists sections_document_id_fkey,
+  add constraint sections_document_id_fkey
+    foreign key (document_id) references public.documents (id) on delete cascade;
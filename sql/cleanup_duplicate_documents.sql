@@ -0,0 +1,43 @@
+-- Полное удаление документов по slug вместе с их chunks и sections.
+-- Вызывается из tools/cleanup_duplicate_documents.py:
+--   supabase.rpc("cleanup_duplicate_documents", {"slugs": [...]})
+-- Все три DELETE выполняются в одной транзакции за один HTTP-запрос:
+-- при ошибке не остаётся ни осиротевших chunks, ни документов без содержимого.
+-- Дочерние строки удаляются через соединение с documents по slug,
+-- id документов клиенту не нужны.
+-- Возвращает одну строку: id удалённых документов и сколько удалено chunks/sections.
+
+drop function if exists public.cleanup_docs_by_slug(text[]);
+
+create or replace function public.cleanup_duplicate_documents(slugs text[])
+returns table (
+  deleted_doc_ids uuid[],
+  chunk_count integer,
+  section_count integer
+)
+language plpgsql
+as $$
+begin
+  delete from public.chunks as c
+  using public.documents as d
+  where c.document_id = d.id
+    and d.slug = any (slugs);
+  get diagnostics chunk_count = row_count;
+
+  delete from public.sections as s
+  using public.documents as d
+  where s.document_id = d.id
+    and d.slug = any (slugs);
+  get diagnostics section_count = row_count;
+
+  with deleted as (
+    delete from public.documents as d
+    where d.slug = any (slugs)
+    returning d.id
+  )
+  select coalesce(array_agg(deleted.id), '{}') into deleted_doc_ids
+  from deleted;
+
+  return next;
+end;
+$$;
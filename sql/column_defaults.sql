@@ -0,0 +1,9 @@
+-- Значения по умолчанию для колонок, которые ingest всегда заполняет одной константой.
+-- Страховка для ручных и сторонних вставок: ingest/pipeline и insert_chunks_bulk
+-- передают status / quality_flag явно, так что порядок применения миграций не важен.
+
+alter table public.chunks
+  alter column quality_flag set default 'ok';
+
+alter table public.documents
+  alter column status set default 'active';
@@ -0,0 +1,27 @@
+-- Удаление chunks документов с указанными slug порциями по lim строк.
+-- Вызывается из tools/cleanup_duplicate_documents.py в цикле, пока не вернёт
+-- меньше lim: каждый вызов — отдельная короткая транзакция, и один огромный
+-- DELETE не держит блокировки на chunks минутами.
+-- Строки, заблокированные другими транзакциями, пропускаются (SKIP LOCKED) —
+-- их удалит финальный cleanup_duplicate_documents.
+-- Возвращает количество удалённых строк.
+
+create or replace function public.delete_chunks_batch(slugs text[], lim integer default 100000)
+returns integer
+language sql
+as $$
+  with victims as (
+    select c.id
+    from public.chunks as c
+    join public.documents as d on d.id = c.document_id
+    where d.slug = any (slugs)
+    limit lim
+    for update of c skip locked
+  ),
+  deleted as (
+    delete from public.chunks
+    where id in (select id from victims)
+    returning 1
+  )
+  select count(*)::integer from deleted;
+$$;
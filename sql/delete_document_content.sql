@@ -0,0 +1,24 @@
+-- Удаление старого содержимого документа перед повторным ingest.
+-- Вызывается из ingest/pipeline (cleanup_existing_content):
+--   supabase.rpc("delete_document_content", {"target_document_id": ...})
+-- Оба DELETE выполняются одним запросом и в одной транзакции;
+-- сначала chunks — они ссылаются на sections.
+-- Возвращает {"chunks": <удалено чанков>, "sections": <удалено секций>}.
+
+create or replace function public.delete_document_content(target_document_id uuid)
+returns jsonb
+language plpgsql
+as $$
+declare
+  chunks_deleted integer;
+  sections_deleted integer;
+begin
+  delete from public.chunks where document_id = target_document_id;
+  get diagnostics chunks_deleted = row_count;
+
+  delete from public.sections where document_id = target_document_id;
+  get diagnostics sections_deleted = row_count;
+
+  return jsonb_build_object('chunks', chunks_deleted, 'sections', sections_deleted);
+end;
+$$;
@@ -0,0 +1,8 @@
+-- Перевод chunks.embedding с vector(1536) (float32) на halfvec(1536) (float16).
+-- Требуется pgvector >= 0.7. Потеря точности на косинусной близости пренебрежимо мала,
+-- а вектор в БД и в выдаче PostgREST занимает вдвое меньше места.
+-- После миграции пересоздать update_embeddings_bulk (sql/update_embeddings_bulk.sql).
+
+alter table public.chunks
+  alter column embedding type halfvec(1536)
+  using embedding::halfvec(1536);
@@ -0,0 +1,29 @@
+-- Массовая вставка чанков одной книги: колонки приходят параллельными массивами.
+-- Вызывается из ingest/pipeline (insert_chunks_batch):
+--   supabase.rpc("insert_chunks_bulk", {"document_id": ..., "section_ids": [...],
+--                "chunk_indexes": [...], "texts": [...], "embeddings": [...]})
+-- embeddings — halfvec-литералы "[...]" или null. Возвращает количество вставленных строк.
+-- quality_flag = 'ok' проставляется здесь, по сети не передаётся
+-- и от значения по умолчанию колонки не зависит.
+
+drop function if exists public.insert_chunks_bulk(uuid, uuid[], integer[], text[], text[], text[]);
+
+create or replace function public.insert_chunks_bulk(
+  document_id uuid,
+  section_ids uuid[],
+  chunk_indexes integer[],
+  texts text[],
+  embeddings text[]
+)
+returns integer
+language sql
+as $$
+  with inserted as (
+    insert into public.chunks (document_id, section_id, chunk_index, text, embedding, quality_flag)
+    select insert_chunks_bulk.document_id, u.section_id, u.chunk_index, u.text, u.embedding::halfvec, 'ok'
+    from unnest(section_ids, chunk_indexes, texts, embeddings)
+      as u(section_id, chunk_index, text, embedding)
+    returning 1
+  )
+  select count(*)::integer from inserted;
+$$;
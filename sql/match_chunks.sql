@@ -0,0 +1,96 @@
+-- Серверный top-k поиск по косинусной близости (pgvector).
+-- Вызывается из rag/retrieval.py:
+--   supabase.rpc("match_chunks", {"query_embedding": "[...]", "match_slugs": [...], "match_count": k})
+-- match_slugs = null — поиск по всем документам.
+-- В ответе только то, что нужно для промпта и цитат: без embedding
+-- и без quality_flag (он всегда 'ok' из-за фильтра).
+-- Колонка embedding — halfvec(1536) (sql/halfvec_embeddings.sql), векторы единичной длины.
+--
+-- Поиск по всему корпусу (match_slugs = null) двухступенчатый:
+--   1) кандидаты — по HNSW-индексу над бинарно квантованными векторами
+--      (1 бит на измерение: индекс в 16 раз меньше, чем над halfvec, и держится в памяти),
+--      расстояние Хэмминга;
+--   2) кандидаты точно переранжируются по косинусу на исходном halfvec.
+-- С фильтром по slug — точный перебор чанков выбранных документов:
+-- HNSW сначала берёт ef_search ближайших по всему корпусу и только потом
+-- применяет фильтр, так что для узкой книги кандидатов могло не остаться вовсе.
+-- Чанков одной-нескольких книг немного, полный перебор по document_id дешёвый.
+-- Требуется pgvector >= 0.7.
+--
+-- Проверка после применения: для книги, где чанков не меньше match_count,
+-- должно прийти ровно match_count строк:
+--   select count(*) from public.match_chunks(
+--     (select embedding from public.chunks where embedding is not null limit 1),
+--     array['<slug>'],
+--     5
+--   );
+
+drop index if exists public.chunks_embedding_hnsw_idx;
+
+create index if not exists chunks_embedding_bq_hnsw_idx
+  on public.chunks using hnsw ((binary_quantize(embedding)::bit(1536)) bit_hamming_ops);
+
+-- тип результата менялся (убран quality_flag), create or replace его не заменит
+drop function if exists public.match_chunks(halfvec, text[], integer);
+
+create or replace function public.match_chunks(
+  query_embedding halfvec(1536),
+  match_slugs text[] default null,
+  match_count integer default 5
+)
+returns table (
+  id uuid,
+  document_id uuid,
+  text text,
+  book_title text,
+  book_series text,
+  similarity double precision
+)
+language plpgsql
+stable
+-- по умолчанию HNSW отдаёт не больше 40 строк, кандидатов нужно больше
+set hnsw.ef_search = 200
+as $$
+#variable_conflict use_column
+begin
+  if match_slugs is null then
+    return query
+    with candidates as (
+      select c.id
+      from public.chunks as c
+      where c.embedding is not null
+        and c.quality_flag = 'ok'
+      order by binary_quantize(c.embedding)::bit(1536) <~> binary_quantize(query_embedding)
+      limit greatest(match_count * 5, 50)
+    )
+    select
+      c.id,
+      c.document_id,
+      c.text,
+      d.title as book_title,
+      d.series as book_series,
+      1 - (c.embedding <=> query_embedding) as similarity
+    from candidates
+    join public.chunks as c on c.id = candidates.id
+    join public.documents as d on d.id = c.document_id
+    order by c.embedding <=> query_embedding
+    limit match_count;
+  else
+    return query
+    select
+      c.id,
+      c.document_id,
+      c.text,
+      d.title as book_title,
+      d.series as book_series,
+      1 - (c.embedding <=> query_embedding) as similarity
+    from public.chunks as c
+    join public.documents as d on d.id = c.document_id
+    where d.slug = any (match_slugs)
+      and c.embedding is not null
+      and c.quality_flag = 'ok'
+    order by c.embedding <=> query_embedding
+    limit match_count;
+  end if;
+end;
+$$;
@@ -0,0 +1,19 @@
+-- Массовое обновление embedding у существующих чанков одним запросом.
+-- Вызывается из ingest/pipeline/build_embeddings.py:
+--   supabase.rpc("update_embeddings_bulk", {"items": [{"id": ..., "embedding": "[...]"}, ...]})
+-- embedding — halfvec-литерал строкой (или JSON-массив чисел).
+-- Возвращает количество обновлённых строк.
+
+create or replace function public.update_embeddings_bulk(items jsonb)
+returns integer
+language sql
+as $$
+  with updated as (
+    update public.chunks as c
+    set embedding = (i.embedding)::halfvec
+    from jsonb_to_recordset(items) as i(id uuid, embedding text)
+    where c.id = i.id
+    returning 1
+  )
+  select count(*)::integer from updated;
+$$;
@@ -2,25 +2,35 @@
 """
 Очистка дублей документов и тестового документа в Supabase.
 
-Удаляет:
-  - customer-intellect
-  - financial-intellect
-  - leadership-intellect
-  - test-document-001
-
-Порядок:
-  1) chunks по document_id
-  2) sections по document_id
-  3) documents по id
-
-DRY_RUN управляет тем, реально ли удалять данные.
+Документы (вместе с их chunks и sections) задаются slug в командной строке:
+
+    python tools/cleanup_duplicate_documents.py customer-intellect test-document-001
+    python tools/cleanup_duplicate_documents.py customer-intellect --execute
+
+Удаление:
+  1) chunks — порциями по CHUNK_DELETE_BATCH (RPC delete_chunks_batch,
+     sql/delete_chunks_batch.sql), чтобы не держать долгих блокировок;
+  2) остальное — одна RPC cleanup_duplicate_documents
+     (sql/cleanup_duplicate_documents.sql): sections и documents удаляются
+     на сервере по slug в одной транзакции.
+Если функции в БД ещё нет — один DELETE по documents по slug,
+chunks и sections удаляются каскадно (sql/cascade_document_fks.sql).
+Любая другая ошибка RPC (права, таймаут блокировки и т.п.) прерывает
+скрипт с ненулевым кодом: в массовый каскадный DELETE она не превращается.
+
+По умолчанию — только показать, что БЫ удалили (dry run);
+реально удаляет только с флагом --execute.
 """
 
+import argparse
 import os
 import sys
 from pathlib import Path
 from typing import List
 
+from postgrest import APIError, CountMethod, ReturnMethod
+from supabase import Client
+
 # -----------------------------------------------------------
 # Настройка PYTHONPATH: добавляем корень проекта в sys.path
 # -----------------------------------------------------------
@@ -32,44 +42,43 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 # Теперь импорт из app.* должен работать так же, как в ingest_*.py
-from app.core.db import get_supabase_client  # type: ignore
-
+from app.core.db import MISSING_FUNCTION_ERROR_CODES, get_supabase_client  # type: ignore
 
-# СЛАГИ, КОТОРЫЕ НУЖНО УДАЛИТЬ ПОЛНОСТЬЮ
-DELETE_SLUGS: List[str] = [
-    "customer-intellect",
-    "financial-intellect",
-    "leadership-intellect",
-    "test-document-001",
-]
 
-# РЕЖИМ ПРОВЕРКИ:
-#   True  – только показать, что БЫ удалили, без реального удаления
-#   False – реально удалить
-DRY_RUN: bool = False
+# Сколько chunks удаляется за один запрос: один огромный DELETE
+# надолго блокирует таблицу chunks
+CHUNK_DELETE_BATCH: int = 100_000
 
 
-def main() -> None:
-    client = get_supabase_client()
+def count_target_documents(client: Client, slugs: List[str]) -> int:
+    """
+    Сколько документов с указанными slug есть в БД.
+    HEAD-запрос с count=exact: приходит только число, без тела ответа.
+    """
+    resp = (
+        client.table("documents")
+        .select("id", count=CountMethod.exact, head=True)
+        .in_("slug", slugs)
+        .execute()
+    )
+    return resp.count or 0
 
-    print("=== Cleanup duplicate/test documents ===")
-    print(f"PROJECT_ROOT = {PROJECT_ROOT}")
-    print(f"DRY_RUN      = {DRY_RUN}")
-    print(f"TARGET SLUGS = {', '.join(DELETE_SLUGS)}")
-    print()
 
-    # 1. Найти все документы с указанными slug
+def print_target_documents(client: Client, slugs: List[str]) -> List[dict]:
+    """
+    Находит и печатает документы с указанными slug.
+    """
     resp = (
         client.table("documents")
         .select("id, slug, title, version, status")
-        .in_("slug", DELETE_SLUGS)
+        .in_("slug", slugs)
         .execute()
     )
 
     docs = resp.data or []
     if not docs:
         print("Нет документов с указанными slug. Нечего удалять.")
-        return
+        return docs
 
     print("Найдены документы для удаления:")
     for d in docs:
@@ -78,48 +87,108 @@ def main() -> None:
             f"title={d.get('title')!r}, version={d.get('version')}, status={d.get('status')}"
         )
     print()
+    return docs
+
+
+def delete_chunks_in_batches(client: Client, slugs: List[str]) -> None:
+    """
+    Удаляет chunks документов порциями по CHUNK_DELETE_BATCH строк
+    (RPC delete_chunks_batch, sql/delete_chunks_batch.sql), пока не удалится
+    неполная порция.
+    """
+    total = 0
+    while True:
+        resp = client.rpc(
+            "delete_chunks_batch",
+            {"slugs": slugs, "lim": CHUNK_DELETE_BATCH},
+        ).execute()
+        deleted = resp.data or 0
+        total += deleted
+        print(f"  chunks batch delete → count={deleted}")
+        if deleted < CHUNK_DELETE_BATCH:
+            break
+    print(f"  chunks deleted    → count={total}")
+
+
+def delete_documents_by_slug(client: Client, slugs: List[str]) -> None:
+    """
+    Запасной путь, если RPC cleanup_duplicate_documents ещё не создана:
+    один DELETE по documents, chunks и sections удаляет сам Postgres
+    (ON DELETE CASCADE, sql/cascade_document_fks.sql).
+    """
+    # DELETE сам возвращает удалённые документы (RETURNING) — отдельный
+    # SELECT для вывода не нужен; строк documents единицы, chunks в ответ не попадают
+    doc_resp = (
+        client.table("documents")
+        .delete(returning=ReturnMethod.representation)
+        .in_("slug", slugs)
+        .execute()
+    )
+    for d in doc_resp.data or []:
+        print(
+            f"  documents deleted → id={d['id']}, slug={d['slug']}, "
+            f"title={d.get('title')!r}, version={d.get('version')}"
+        )
+
 
-    if DRY_RUN:
-        print("DRY_RUN = True → реальные DELETE-запросы НЕ выполняются.")
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Полное удаление документов (с chunks и sections) по slug."
+    )
+    parser.add_argument(
+        "slugs",
+        nargs="+",
+        help="slug документов, которые нужно удалить полностью",
+    )
+    parser.add_argument(
+        "--execute",
+        action="store_true",
+        help="Реально удалить. Без флага — только показать, что БЫ удалили (dry run).",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    slugs: List[str] = args.slugs
+    dry_run = not args.execute
+
+    client = get_supabase_client()
+
+    print("=== Cleanup duplicate/test documents ===")
+    print(f"PROJECT_ROOT = {PROJECT_ROOT}")
+    print(f"DRY_RUN      = {dry_run}")
+    print(f"TARGET SLUGS = {', '.join(slugs)}")
+    print()
+
+    # Частый случай «удалять нечего» — один лёгкий HEAD-запрос
+    if count_target_documents(client, slugs) == 0:
+        print("Нет документов с указанными slug. Нечего удалять.")
         return
 
-    # 2. Удаление по каждому документу
-    for d in docs:
-        doc_id = d["id"]
-        slug = d["slug"]
-        title = d.get("title")
-
-        print(f"--- Удаление документа slug={slug}, id={doc_id} ---")
-
-        # 2.1 Удаляем chunks
-        chunks_resp = (
-            client.table("chunks")
-            .delete()
-            .eq("document_id", doc_id)
-            .execute()
-        )
-        print(f"  chunks delete → data={chunks_resp.data} count={chunks_resp.count}")
-
-        # 2.2 Удаляем sections
-        sections_resp = (
-            client.table("sections")
-            .delete()
-            .eq("document_id", doc_id)
-            .execute()
-        )
-        print(
-            f"  sections delete → data={sections_resp.data} count={sections_resp.count}"
-        )
+    if dry_run:
+        print_target_documents(client, slugs)
+        print("DRY_RUN = True → реальные DELETE-запросы НЕ выполняются (нужен --execute).")
+        return
 
-        # 2.3 Удаляем сам document
-        doc_resp = (
-            client.table("documents")
-            .delete()
-            .eq("id", doc_id)
-            .execute()
-        )
-        print(f"  documents delete → data={doc_resp.data} count={doc_resp.count}")
-        print(f"--- Готово для slug={slug}, title={title!r} ---\n")
+    # Сначала chunks — порциями, короткими транзакциями; затем остальное —
+    # одной RPC в одной транзакции: sections удаляются на сервере
+    # через соединение с documents по slug
+    try:
+        delete_chunks_in_batches(client, slugs)
+        resp = client.rpc("cleanup_duplicate_documents", {"slugs": slugs}).execute()
+    except APIError as e:
+        if e.code not in MISSING_FUNCTION_ERROR_CODES:
+            print(f"Ошибка RPC ({e.code}: {e.message}) → очистка прервана", file=sys.stderr)
+            sys.exit(1)
+        print(f"RPC недоступна ({e.message}) → DELETE по documents")
+        delete_documents_by_slug(client, slugs)
+    else:
+        result = resp.data[0]
+        print(f"  documents deleted → ids={result['deleted_doc_ids']}")
+        print(f"  sections deleted  → count={result['section_count']}")
+        if result["chunk_count"]:
+            print(f"  chunks deleted    → count={result['chunk_count']} (после порций)")
 
     print("=== Cleanup finished ===")
 